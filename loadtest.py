@@ -0,0 +1,915 @@
+"""Offline load tests for the payment bot.
+
+Drives beli, process_payment, payment_notification, checkpay and
+schedule_role_removal end to end against in-process stand-ins for the
+Discord gateway, Midtrans and Google Sheets, then appends the results to a
+JSONL file so later runs can be compared against them.
+
+    python loadtest.py                             # every scenario
+    python loadtest.py registration --users 500    # one scenario
+    python loadtest.py --check                     # exit 1 on a regression
+    python loadtest.py storage                     # a benchmark, by name only
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import aiohttp
+from aiohttp import web
+
+SERVER_KEY = 'loadtest-server-key'
+GUILD_ID = 1
+BOT_USER_ID = 10
+FIRST_USER_ID = 1_000_000
+SCENARIOS = ('registration', 'dispatch', 'checkpay', 'webhook', 'rollover', 'retention')
+BENCHMARKS = ('storage', 'history', 'multiworker', 'startup')  # Large data sets or extra processes; only run when named
+
+main = None  # The bot module, imported once the environment is prepared
+
+
+# Stand-ins for the Discord objects the bot touches. Every REST call made
+# through them sleeps for the configured Discord latency
+class FakeDiscord:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+class FakeRole:
+    def __init__(self, role_id, name, position):
+        self.id = role_id
+        self.name = name
+        self.position = position
+
+class FakeMember:
+    def __init__(self, discord_api, user_id, name, top_role=None):
+        self.discord_api = discord_api
+        self.id = user_id
+        self.name = name
+        self.roles = set()
+        self.top_role = top_role
+        self.removed_at = None
+        self.grants = 0
+
+    async def add_roles(self, *roles):
+        await self.discord_api.call()
+        self.roles.update(role.id for role in roles)
+        self.grants += 1
+
+    async def remove_roles(self, *roles):
+        await self.discord_api.call()
+        self.roles.difference_update(role.id for role in roles)
+        self.removed_at = time.perf_counter()
+
+    async def send(self, content=None, **kwargs):
+        await self.discord_api.call()
+
+class FakeSentMessage:
+    def __init__(self, discord_api):
+        self.discord_api = discord_api
+
+    async def edit(self, **kwargs):
+        await self.discord_api.call()
+
+class FakeChannel:
+    def __init__(self, discord_api, channel_id, name):
+        self.discord_api = discord_api
+        self.id = channel_id
+        self.name = name
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await self.discord_api.call()
+        self.sent += 1
+        return FakeSentMessage(self.discord_api)
+
+class FakeGuild:
+    def __init__(self, discord_api, channels):
+        self.discord_api = discord_api
+        self.id = GUILD_ID
+        self.name = 'Load Test Guild'
+        bot_role = FakeRole(100, 'Bot', 10)
+        self.roles = [
+            FakeRole(101, 'THE WARRIORS MONTHLY', 2),
+            FakeRole(102, 'THE FELLOWS MONTHLY', 1),
+            bot_role,
+        ]
+        self.members = {BOT_USER_ID: FakeMember(discord_api, BOT_USER_ID, 'payment-bot', top_role=bot_role)}
+        self.text_channels = [FakeChannel(discord_api, 500 + i, f'channel-{i}') for i in range(channels)]
+
+    @property
+    def me(self):
+        return self.members[BOT_USER_ID]
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.text_channels if channel.id == channel_id), None)
+
+    def add_member(self, user_id):
+        member = FakeMember(self.discord_api, user_id, f'user-{user_id}')
+        self.members[user_id] = member
+        return member
+
+    def get_role(self, name):
+        return next(role for role in self.roles if role.name == name)
+
+class FakeContext:
+    def __init__(self, author, channel):
+        self.author = author
+        self.channel = channel
+        self.view = None
+
+    async def send(self, content=None, view=None, **kwargs):
+        if view is not None:
+            self.view = view
+        return await self.channel.send(content, view=view, **kwargs)
+
+class FakeInteractionResponse:
+    async def defer(self):
+        pass
+
+class FakeInteraction:
+    def __init__(self, user, channel):
+        self.user = user
+        self.response = FakeInteractionResponse()
+        self.followup = channel
+        self.message = FakeSentMessage(channel.discord_api)
+
+class FakeMessage:
+    def __init__(self, author, channel, content):
+        self.author = author
+        self.channel = channel
+        self.content = content
+
+class FakeRequest:
+    def __init__(self, data):
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+# Stand-in for the googleapiclient Sheets service. execute() runs in a worker
+# thread like the real client, so it blocks for the configured latency
+class FakeSheetsService:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = 0
+        self.requests = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def append(self, body=None, **kwargs):
+        self.pending = body['values']
+        return self
+
+    def execute(self):
+        time.sleep(self.latency)
+        self.requests += 1
+        self.rows += len(self.pending)
+        return {'updates': {'updatedCells': len(self.pending) * 8}}
+
+async def start_fake_midtrans(latency):
+    async def charge(request):
+        payload = await request.json()
+        await asyncio.sleep(latency)
+        order_id = payload['transaction_details']['order_id']
+        return web.json_response({
+            'token': order_id,
+            'redirect_url': f'https://app.sandbox.midtrans.com/snap/v2/vtweb/{order_id}',
+        })
+
+    app = web.Application()
+    app.router.add_post('/charge', charge)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://127.0.0.1:{port}'
+
+# Runs main.py as __main__ with Discord unreachable: resolving discord.com
+# hangs, so the gateway login neither completes nor fails during the run
+UNREACHABLE_DISCORD = '''
+import runpy, socket, time
+resolve = socket.getaddrinfo
+def getaddrinfo(host, *args, **kwargs):
+    if host == 'discord.com':
+        time.sleep(3600)
+    return resolve(host, *args, **kwargs)
+socket.getaddrinfo = getaddrinfo
+runpy.run_path('main.py', run_name='__main__')
+'''
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(scenario, params, latencies, duration, extra=None):
+    result = {
+        'scenario': scenario,
+        'params': params,
+        'count': len(latencies),
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(len(latencies) / duration, 1) if duration else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if tracemalloc.is_tracing():
+        result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.reset_peak()
+    if extra:
+        result.update(extra)
+    return result
+
+def sign(order_id, status_code, gross_amount):
+    return hashlib.sha512(f"{order_id}{status_code}{gross_amount}{SERVER_KEY}".encode()).hexdigest()
+
+def signed_notification(order_id, transaction_status='settlement'):
+    # What Midtrans sends for a seeded order, priced from the catalog like the charge was
+    gross_amount = f"{main.catalog.get(main.payment_status[order_id].role).price}.00"
+    return {
+        'order_id': order_id,
+        'transaction_status': transaction_status,
+        'status_code': '200',
+        'gross_amount': gross_amount,
+        'signature_key': sign(order_id, '200', gross_amount),
+    }
+
+async def wait_until(predicate, interval=0.01):
+    while not predicate():
+        await asyncio.sleep(interval)
+
+async def drain_side_effects():
+    await wait_until(lambda: main.store.inbox_backlog() == 0)
+    await wait_until(lambda: not main.role_grant_tasks and main.role_queue.depth() == 0)
+    await main.flush_sheet_rows()
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.discord_api = FakeDiscord(args.discord_latency / 1000)
+        self.guild = FakeGuild(self.discord_api, args.channels)
+        self.sheets = FakeSheetsService(args.sheets_latency / 1000)
+        self.registration_channel = FakeChannel(self.discord_api, 400, 'registrasi')
+        self.next_user_id = FIRST_USER_ID
+        self.tasks = []
+
+    def new_member(self):
+        self.next_user_id += 1
+        return self.guild.add_member(self.next_user_id)
+
+    async def start(self):
+        self.midtrans_runner, midtrans_url = await start_fake_midtrans(self.args.midtrans_latency / 1000)
+        main.MIDTRANS_ENDPOINT = f'{midtrans_url}/charge'
+        main.service = self.sheets
+        main.bot.get_guild = lambda guild_id: self.guild if guild_id == GUILD_ID else None
+        main.bot.get_user = self.guild.get_member
+        main.bot._connection.user = self.guild.me
+        main.load_data()
+        main.role_queue.start()
+        main.sessions.start()
+        self.tasks = [asyncio.create_task(main.sheet_writer()), asyncio.create_task(main.inbox_consumer())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        main.role_queue.stop()
+        main.sessions.stop()
+        await main.flush_sheet_rows()
+        await main.close_midtrans_session()
+        await self.midtrans_runner.cleanup()
+
+    async def reply(self, member, content):
+        key = (self.registration_channel.id, member.id)
+        await wait_until(lambda: key in main.sessions.waiters, interval=0.001)
+        main.sessions.dispatch(FakeMessage(member, self.registration_channel, content))
+
+    async def register(self, member, role_name):
+        started = time.perf_counter()
+        ctx = FakeContext(member, self.registration_channel)
+        command = asyncio.create_task(main.beli.callback(ctx))
+        await self.reply(member, f'user{member.id}@example.com')
+        await self.reply(member, f'User {member.id}')
+        await self.reply(member, '081234567890')
+        await command
+
+        select = ctx.view.children[0]
+        select._values = [role_name]
+        callback = asyncio.create_task(select.callback(FakeInteraction(member, self.registration_channel)))
+        min_score = main.catalog.get(role_name).min_score
+        if min_score is not None:
+            await self.reply(member, str(min_score))
+        await callback
+        return time.perf_counter() - started
+
+    def seed_pending_orders(self, count):
+        order_ids = []
+        for _ in range(count):
+            member = self.new_member()
+            order_id = f'order-{member.id}-{int(time.time())}'
+            registration = main.touch_registration(member.id)
+            registration.member_name = member.name
+            registration.email = f'user{member.id}@example.com'
+            main.payment_status.add(order_id, main.Order(member.id, 'THE FELLOWS MONTHLY', 'pending'))
+            order_ids.append(order_id)
+        return order_ids
+
+    async def scenario_registration(self):
+        users = self.args.users
+        members = [self.new_member() for _ in range(users)]
+        roles = ['THE WARRIORS MONTHLY' if random.random() < 0.2 else 'THE FELLOWS MONTHLY' for _ in members]
+        # Individual charge latencies, next to the histogram the bot keeps anyway
+        charge_latencies = []
+        observe = main.MIDTRANS_LATENCY.observe
+        main.MIDTRANS_LATENCY.observe = lambda value: (charge_latencies.append(value), observe(value))
+        charges_before = main.MIDTRANS_LATENCY.count
+        started = time.perf_counter()
+        try:
+            latencies = await asyncio.gather(*(self.register(member, role) for member, role in zip(members, roles)))
+        finally:
+            main.MIDTRANS_LATENCY.observe = observe
+        duration = time.perf_counter() - started
+        charges = main.MIDTRANS_LATENCY.count - charges_before
+        created = sum(1 for member in members if main.payment_status.for_user(member.id))
+        return summarize('registration', {'users': users}, latencies, duration, {
+            'orders_created': created,
+            'charges_per_s': round(charges / duration, 1) if duration else 0.0,
+            'midtrans_p99_ms': round(percentile(charge_latencies, 99) * 1000, 2),
+        })
+
+    async def scenario_dispatch(self):
+        # Routing cost per incoming message with --sessions registrations
+        # waiting for a reply, against evaluating one wait_for check per
+        # pending registration as the old !beli did
+        open_sessions = self.args.sessions
+        members = [self.new_member() for _ in range(open_sessions)]
+        channel_id = self.registration_channel.id
+        waiters = [asyncio.create_task(main.sessions.wait_for_message(channel_id, member.id, timeout=600))
+                   for member in members]
+        await wait_until(lambda: all(main.sessions.waiters.get((channel_id, member.id)) for member in members))
+
+        chatter = FakeMessage(self.new_member(), self.registration_channel, 'halo semua')
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(self.args.messages):
+            dispatch_started = time.perf_counter()
+            await main.route_session_message(chatter)
+            latencies.append(time.perf_counter() - dispatch_started)
+        duration = time.perf_counter() - started
+
+        checks = [lambda message, author_id=member.id: message.author.id == author_id and message.channel.id == channel_id
+                  for member in members]
+        scan_started = time.perf_counter()
+        for _ in range(100):
+            for check in checks:
+                check(chatter)
+        per_message_scan = (time.perf_counter() - scan_started) / 100
+
+        reply_latencies = []
+        for member in members:
+            reply = FakeMessage(member, self.registration_channel, f'user{member.id}@example.com')
+            reply_started = time.perf_counter()
+            await main.route_session_message(reply)
+            reply_latencies.append(time.perf_counter() - reply_started)
+        await asyncio.gather(*waiters)
+        return summarize('dispatch', {'sessions': open_sessions, 'messages': self.args.messages}, latencies, duration, {
+            'dispatch_p99_us': round(percentile(latencies, 99) * 1_000_000, 2),
+            'reply_p99_us': round(percentile(reply_latencies, 99) * 1_000_000, 2),
+            'wait_for_checks_us': round(per_message_scan * 1_000_000, 2),
+        })
+
+    async def scenario_checkpay(self):
+        users = self.args.users
+        members = [self.guild.get_member(int(order_id.split('-')[1])) for order_id in self.seed_pending_orders(users)]
+
+        async def check(member):
+            started = time.perf_counter()
+            await main.checkpay.callback(FakeContext(member, self.registration_channel))
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(check(member) for member in members))
+        return summarize('checkpay', {'users': users, 'orders_total': len(main.payment_status)},
+                         latencies, time.perf_counter() - started)
+
+    async def scenario_history(self):
+        # Per-user lookups with --history-orders settled orders already in
+        # memory, against the full scan !checkpay and process_payment used to do
+        history = self.args.history_orders
+        users = max(1, history // 5)
+        historical = []
+        for i in range(history):
+            order_id = f'order-{FIRST_USER_ID + i % users}-{i}'
+            main.payment_status.cache(order_id, main.Order(FIRST_USER_ID + i % users, 'THE FELLOWS MONTHLY', 'settled', 0))
+            historical.append(order_id)
+        self.next_user_id = max(self.next_user_id, FIRST_USER_ID + users)
+        members = [self.guild.get_member(int(order_id.split('-')[1])) for order_id in self.seed_pending_orders(self.args.users)]
+
+        latencies = []
+        started = time.perf_counter()
+        for member in members:
+            lookup_started = time.perf_counter()
+            orders = main.payment_status.for_user(member.id)
+            [order_id for order_id, order in orders.items() if order.status == 'pending']
+            latencies.append(time.perf_counter() - lookup_started)
+        duration = time.perf_counter() - started
+
+        scan_started = time.perf_counter()
+        for member in members[:10]:
+            {order_id: order for order_id, order in main.payment_status.orders.items() if order.user_id == member.id}
+        full_scan = (time.perf_counter() - scan_started) / min(10, len(members))
+
+        checkpay_started = time.perf_counter()
+        await asyncio.gather(*(main.checkpay.callback(FakeContext(member, self.registration_channel)) for member in members))
+        checkpay_duration = time.perf_counter() - checkpay_started
+
+        result = summarize('history', {'history_orders': history, 'users': len(members)}, latencies, duration, {
+            'full_scan_ms': round(full_scan * 1000, 2),
+            'checkpay_s': round(checkpay_duration, 3),
+        })
+        for order_id in historical:
+            main.payment_status.remove(order_id)
+        return result
+
+    async def scenario_webhook(self):
+        orders = self.args.orders
+        notifications = []
+        for order_id in self.seed_pending_orders(orders):
+            notifications.extend([signed_notification(order_id)] * self.args.duplicates)
+        # Forged copies of real orders: well-formed, but signed for another amount
+        forged = [dict(data, signature_key=sign(data['order_id'], '200', '1.00'))
+                  for data in random.sample(notifications, int(len(notifications) * self.args.forged))]
+        forged_ids = {id(data) for data in forged}
+        notifications.extend(forged)
+        random.shuffle(notifications)
+
+        # Paced at --webhook-rate requests per second, like Midtrans delivering a burst
+        interval = 1 / self.args.webhook_rate
+        latencies = []
+        forged_latencies = []
+        forged_accepted = 0
+
+        async def deliver(data, due):
+            nonlocal forged_accepted
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            sent = time.perf_counter()
+            response = await main.payment_notification(FakeRequest(data))
+            latencies.append(time.perf_counter() - sent)
+            if id(data) in forged_ids:
+                forged_latencies.append(latencies[-1])
+                forged_accepted += response.status_code != 403
+
+        started = time.perf_counter()
+        await asyncio.gather(*(deliver(data, started + i * interval) for i, data in enumerate(notifications)))
+        ack_duration = time.perf_counter() - started
+        await drain_side_effects()
+        drain_duration = time.perf_counter() - started
+        settled = sum(1 for order_id in main.payment_status.with_status('settled'))
+
+        # The signature stage on its own, outside the event loop's scheduling noise
+        valid = next(data for data in notifications if id(data) not in forged_ids)
+        verify = {}
+        for name, data in (('valid', valid), ('forged', forged[0] if forged else None)):
+            if data is None:
+                continue
+            verify_started = time.perf_counter()
+            for _ in range(10_000):
+                main.verify_signature(data)
+            verify[f'verify_{name}_us'] = round((time.perf_counter() - verify_started) / 10_000 * 1_000_000, 2)
+
+        return summarize('webhook', {'orders': orders, 'duplicates': self.args.duplicates, 'rate': self.args.webhook_rate,
+                                     'forged': self.args.forged},
+                         latencies, ack_duration,
+                         {'drain_s': round(drain_duration, 3), 'settled': settled,
+                          'sheet_rows': self.sheets.rows, 'sheet_requests': self.sheets.requests,
+                          'forged_sent': len(forged_latencies), 'forged_accepted': forged_accepted,
+                          'forged_p99_ms': round(percentile(forged_latencies, 99) * 1000, 2), **verify})
+
+    async def scenario_rollover(self):
+        expiries = self.args.expiries
+        role = self.guild.get_role('THE FELLOWS MONTHLY')
+        members = [self.new_member() for _ in range(expiries)]
+        expired_at = time.time() - 1
+        for member in members:
+            member.roles.add(role.id)
+            main.role_expiry[member.id] = (role, expired_at)
+        main.rebuild_expiry_heap()
+        main.END_CLASS_DATE = datetime.now() - timedelta(days=1)
+
+        started = time.perf_counter()
+        await main.schedule_role_removal()
+        await wait_until(lambda: main.role_queue.depth() == 0)
+        duration = time.perf_counter() - started
+        latencies = [member.removed_at - started for member in members if member.removed_at]
+        return summarize('rollover', {'expiries': expiries, 'channels': self.args.channels,
+                                      'role_rate': float(os.environ['ROLE_QUEUE_RATE'])},
+                         latencies, duration,
+                         {'announcements': sum(channel.sent for channel in self.guild.text_channels)})
+
+    async def scenario_storage(self):
+        # Persistence cost against the old data.json, which was rewritten in
+        # full on every change. Each size gets its own JSON file and SQLite
+        # store; the store is timed per status change and on a full load
+        results = []
+        for size in self.args.storage_sizes:
+            work_dir = tempfile.mkdtemp(prefix=f'loadtest-storage-{size}-')
+            users = max(1, size // 2)
+            orders = {f'order-{FIRST_USER_ID + i % users}-{i}': main.Order(FIRST_USER_ID + i % users, 'THE FELLOWS MONTHLY',
+                                                                            'settled', time.time())
+                      for i in range(size)}
+            snapshot = {
+                'user_emails': {str(FIRST_USER_ID + i): f'user{FIRST_USER_ID + i}@example.com' for i in range(users)},
+                'payment_status': {order_id: {'user_id': order.user_id, 'role': order.role, 'status': order.status}
+                                   for order_id, order in orders.items()},
+            }
+
+            json_file = os.path.join(work_dir, 'data.json')
+            started = time.perf_counter()
+            with open(json_file, 'w') as f:
+                json.dump(snapshot, f)
+            json_save = time.perf_counter() - started
+            started = time.perf_counter()
+            with open(json_file, 'r') as f:
+                json.load(f)
+            json_load = time.perf_counter() - started
+
+            db_file = os.path.join(work_dir, 'data.db')
+            store = main.SQLiteStore(db_file)
+            store.conn.execute('BEGIN')
+            for order_id, order in orders.items():
+                store.save_order(order_id, order)
+            store.conn.execute('COMMIT')
+            order_ids = random.sample(list(orders), min(self.args.storage_writes, size))
+            latencies = []
+            started = time.perf_counter()
+            for order_id in order_ids:
+                write_started = time.perf_counter()
+                store.set_order_status(order_id, 'canceled')
+                latencies.append(time.perf_counter() - write_started)
+            duration = time.perf_counter() - started
+            load_started = time.perf_counter()
+            store.load(0)
+            sqlite_load = time.perf_counter() - load_started
+            store.close()
+
+            results.append(summarize('storage', {'orders': size}, latencies, duration, {
+                'json_save_ms': round(json_save * 1000, 2),
+                'json_load_ms': round(json_load * 1000, 2),
+                'json_mb': round(os.path.getsize(json_file) / 1024 / 1024, 1),
+                'sqlite_load_ms': round(sqlite_load * 1000, 2),
+                'sqlite_mb': round(os.path.getsize(db_file) / 1024 / 1024, 1),
+            }))
+            del orders, snapshot
+            for name in os.listdir(work_dir):
+                os.remove(os.path.join(work_dir, name))
+            os.rmdir(work_dir)
+        return results
+
+    async def scenario_multiworker(self):
+        # The RUN_MODE=web handoff: --web-workers uvicorn worker processes
+        # accept the notifications into the shared DB_FILE, and this process
+        # acts as the gateway whose inbox consumer applies them. Every order
+        # must settle exactly once: one grant and one sheet row each
+        orders = self.args.orders
+        order_ids = self.seed_pending_orders(orders)
+        members = [self.guild.get_member(int(order_id.split('-')[1])) for order_id in order_ids]
+        rows_before = self.sheets.rows
+
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        workers = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+             '--workers', str(self.args.web_workers), '--log-level', 'warning'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, RUN_MODE='web'))
+        url = f'http://127.0.0.1:{port}'
+        latencies = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                async def ready():
+                    try:
+                        async with session.get(f'{url}/metrics') as response:
+                            return response.status == 200
+                    except aiohttp.ClientError:
+                        return False
+
+                deadline = time.perf_counter() + 30
+                while not await ready():
+                    if time.perf_counter() > deadline or workers.poll() is not None:
+                        raise RuntimeError('uvicorn workers did not start')
+                    await asyncio.sleep(0.2)
+
+                notifications = []
+                for order_id in order_ids:
+                    notifications.extend([signed_notification(order_id)] * self.args.duplicates)
+                random.shuffle(notifications)
+                semaphore = asyncio.Semaphore(64)
+
+                async def deliver(data):
+                    async with semaphore:
+                        sent = time.perf_counter()
+                        async with session.post(f'{url}/payment-notification', json=data) as response:
+                            await response.read()
+                        latencies.append(time.perf_counter() - sent)
+
+                started = time.perf_counter()
+                await asyncio.gather(*(deliver(data) for data in notifications))
+                duration = time.perf_counter() - started
+        finally:
+            workers.terminate()
+            workers.wait(timeout=30)
+
+        try:
+            await asyncio.wait_for(wait_until(lambda: all(main.payment_status[order_id].status == 'settled'
+                                                          for order_id in order_ids)), timeout=60)
+        except asyncio.TimeoutError:
+            pass
+        await drain_side_effects()
+        settled = sum(1 for order_id in order_ids if main.payment_status[order_id].status == 'settled')
+        duplicate_grants = sum(1 for member in members if member.grants > 1)
+        missing_grants = sum(1 for member in members if member.grants == 0)
+        sheet_rows = self.sheets.rows - rows_before
+        return summarize('multiworker', {'orders': orders, 'duplicates': self.args.duplicates,
+                                         'web_workers': self.args.web_workers},
+                         latencies, duration, {
+                             'settle_s': round(time.perf_counter() - started, 3),
+                             'settled': settled,
+                             'duplicate_grants': duplicate_grants,
+                             'missing_grants': missing_grants,
+                             'sheet_rows': sheet_rows,
+                             'failures': (orders - settled) + duplicate_grants + missing_grants + abs(sheet_rows - orders),
+                         })
+
+    async def scenario_startup(self):
+        # Cold start of `python main.py` until /metrics answers, with an empty
+        # Google cache and a service account URL that never responds, so
+        # nothing on the way to serving HTTP may wait on the network
+        results = []
+        with socket.socket() as stalled:
+            stalled.bind(('127.0.0.1', 0))
+            stalled.listen()  # Accepts connections, never answers them
+            json_file_url = f'http://127.0.0.1:{stalled.getsockname()[1]}/service_account.json'
+            for run_mode in ('all', 'web'):
+                work_dir = tempfile.mkdtemp(prefix=f'loadtest-startup-{run_mode}-')
+                with socket.socket() as probe:
+                    probe.bind(('127.0.0.1', 0))
+                    port = probe.getsockname()[1]
+                env = dict(os.environ, RUN_MODE=run_mode, PORT=str(port), WEB_WORKERS='1',
+                           JSON_FILE_URL=json_file_url,
+                           DB_FILE=os.path.join(work_dir, 'data.db'),
+                           SHEET_SPOOL_FILE=os.path.join(work_dir, 'sheet_spool.jsonl'),
+                           GOOGLE_CACHE_DIR=os.path.join(work_dir, 'cache'),
+                           ARCHIVE_DIR=os.path.join(work_dir, 'archive'))
+                command = [sys.executable, '-c', UNREACHABLE_DISCORD] if run_mode == 'all' else [sys.executable, 'main.py']
+                log_file = os.path.join(work_dir, 'main.log')
+                started = time.perf_counter()
+                with open(log_file, 'w') as log:
+                    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                               stdout=log, stderr=subprocess.STDOUT)
+                try:
+                    async with aiohttp.ClientSession() as session:
+                        deadline = started + 30
+                        while True:
+                            try:
+                                async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                                    if response.status == 200:
+                                        text = await response.text()
+                                        break
+                            except aiohttp.ClientError:
+                                pass
+                            if time.perf_counter() > deadline or process.poll() is not None:
+                                raise RuntimeError(f'RUN_MODE={run_mode} did not start serving /metrics, see {log_file}')
+                            await asyncio.sleep(0.02)
+                    ready = time.perf_counter() - started
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+
+                phases = {}
+                for line in text.splitlines():
+                    if line.startswith('startup_phase_seconds{'):
+                        labels, value = line.rsplit(' ', 1)
+                        phases[labels.split('"')[1]] = round(float(value), 3)
+                http_ready = phases.get('http ready', ready)
+                results.append(summarize('startup', {'run_mode': run_mode}, [ready], ready, {
+                    'process_ready_s': round(ready, 3),
+                    'startup_phases': phases,
+                    'failures': int(http_ready >= self.args.startup_budget),
+                }))
+        return results
+
+    async def scenario_retention(self):
+        # A simulated year: one cohort a month, each leaving settled, canceled
+        # and abandoned registrations behind, then one retention sweep
+        cohorts = 12
+        per_cohort = self.args.cohort_users
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        now = time.time()
+        simulated = []
+        for cohort in range(cohorts):
+            created_at = now - (cohorts - cohort) * 30 * 24 * 60 * 60
+            for _ in range(per_cohort):
+                self.next_user_id += 1
+                user_id = self.next_user_id
+                registration = main.touch_registration(user_id)
+                registration.member_name = f'user-{user_id}'
+                registration.email = f'user{user_id}@example.com'
+                registration.name = f'User {user_id}'
+                registration.last_active = created_at
+                simulated.append(user_id)
+                main.store.set_user_field(user_id, 'email', registration.email)
+                outcome = random.random()
+                if outcome < 0.1:
+                    continue  # Abandoned !beli session
+                status = 'settled' if outcome < 0.8 else 'canceled'
+                main.payment_status.add(f'order-{user_id}-{int(created_at)}',
+                                        main.Order(user_id, 'THE FELLOWS MONTHLY', status, created_at))
+        # touch_registration put them at the recent end of the LRU order;
+        # move them ahead of the registrations earlier scenarios left behind,
+        # oldest first, as if they had really been active months ago
+        for user_id in reversed(simulated):
+            main.registrations.move_to_end(user_id, last=False)
+        before = tracemalloc.get_traced_memory()[0] - baseline
+        orders_before = len(main.payment_status)
+        registrations_before = len(main.registrations)
+
+        started = time.perf_counter()
+        await main.run_retention_sweep()
+        duration = time.perf_counter() - started
+        after = tracemalloc.get_traced_memory()[0] - baseline
+        if not was_tracing:
+            tracemalloc.stop()
+
+        archive_bytes = sum(os.path.getsize(os.path.join(main.ARCHIVE_DIR, name))
+                            for name in os.listdir(main.ARCHIVE_DIR)) if os.path.isdir(main.ARCHIVE_DIR) else 0
+        return summarize('retention', {'cohorts': cohorts, 'cohort_users': per_cohort}, [duration], duration, {
+            'memory_before_mb': round(before / 1024 / 1024, 2),
+            'memory_after_mb': round(after / 1024 / 1024, 2),
+            'orders_before': orders_before,
+            'orders_after': len(main.payment_status),
+            'registrations_before': registrations_before,
+            'registrations_after': len(main.registrations),
+            'archive_kb': round(archive_bytes / 1024, 1),
+        })
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_previous_results(path):
+    previous = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    previous[(result['scenario'], json.dumps(result['params'], sort_keys=True))] = result
+    except FileNotFoundError:
+        pass
+    return previous
+
+def find_regressions(result, baseline, tolerance):
+    regressions = []
+    if baseline['p99_ms'] and result['p99_ms'] > baseline['p99_ms'] * (1 + tolerance):
+        regressions.append(f"p99 {baseline['p99_ms']} -> {result['p99_ms']} ms")
+    if baseline['throughput_per_s'] and result['throughput_per_s'] < baseline['throughput_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput_per_s']} -> {result['throughput_per_s']}/s")
+    return regressions
+
+async def run(args):
+    harness = Harness(args)
+    await harness.start()
+    results = []
+    try:
+        for scenario in args.scenarios:
+            result = await getattr(harness, f'scenario_{scenario}')()
+            results.extend(result if isinstance(result, list) else [result])  # Benchmarks may report one per size
+    finally:
+        await harness.stop()
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Checked by hand: with nargs='*' argparse validates the default, or an
+    # empty list, against choices as if it were a single value
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f"any of {', '.join(SCENARIOS + BENCHMARKS)} (default: {', '.join(SCENARIOS)})")
+    parser.add_argument('--users', type=int, default=500, help='registrants for registration/checkpay')
+    parser.add_argument('--sessions', type=int, default=1000, help='open registration sessions in dispatch')
+    parser.add_argument('--messages', type=int, default=100_000, help='unrelated messages routed in dispatch')
+    parser.add_argument('--orders', type=int, default=1000, help='settled orders in the webhook storm')
+    parser.add_argument('--duplicates', type=int, default=2, help='deliveries of each notification')
+    parser.add_argument('--forged', type=float, default=0.2, help='forged notifications added, as a fraction of the real ones')
+    parser.add_argument('--web-workers', type=int, default=4, help='uvicorn worker processes in multiworker')
+    parser.add_argument('--startup-budget', type=float, default=1.0, help="seconds from import to 'http ready' in startup")
+    parser.add_argument('--webhook-rate', type=float, default=1000, help='notifications per second')
+    parser.add_argument('--expiries', type=int, default=5000, help='roles expiring at cohort rollover')
+    parser.add_argument('--cohort-users', type=int, default=2000, help='registrants per monthly cohort in retention')
+    parser.add_argument('--history-orders', type=int, default=1_000_000, help='historical orders in memory for history')
+    parser.add_argument('--storage-sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help='order counts for the storage benchmark')
+    parser.add_argument('--storage-writes', type=int, default=1000, help='status changes timed per storage size')
+    parser.add_argument('--channels', type=int, default=20, help='text channels receiving the announcement')
+    parser.add_argument('--discord-latency', type=float, default=20, help='ms per fake Discord REST call')
+    parser.add_argument('--midtrans-latency', type=float, default=150, help='ms per fake Midtrans charge')
+    parser.add_argument('--sheets-latency', type=float, default=300, help='ms per fake Sheets append')
+    parser.add_argument('--role-rate', type=float, default=200, help='ROLE_QUEUE_RATE used for the run')
+    parser.add_argument('--results', default='loadtest_results.jsonl', help='JSONL file the results are appended to')
+    parser.add_argument('--check', action='store_true', help='exit 1 if a scenario regressed against the last stored run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative change before --check fails')
+    parser.add_argument('--trace-memory', action='store_true', help='report tracemalloc peaks (slows the run)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS + BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)} (choose from {', '.join(SCENARIOS + BENCHMARKS)})")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+def main_cli():
+    global main
+    args = parse_args()
+    random.seed(args.seed)
+
+    # The bot reads its configuration at import time
+    work_dir = tempfile.mkdtemp(prefix='loadtest-')
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    os.environ.update({
+        'DISCORD_TOKEN': 'loadtest',
+        'GUILD_ID': str(GUILD_ID),
+        'MIDTRANS_SERVER_KEY': SERVER_KEY,
+        'MIDTRANS_ENDPOINT': 'http://127.0.0.1/charge',
+        'SPREADSHEET_ID': 'loadtest',
+        'DB_FILE': os.path.join(work_dir, 'data.db'),
+        'SHEET_SPOOL_FILE': os.path.join(work_dir, 'sheet_spool.jsonl'),
+        'GOOGLE_CACHE_DIR': os.path.join(work_dir, 'cache'),
+        'ARCHIVE_DIR': os.path.join(work_dir, 'archive'),
+        'CATALOG_FILE': os.environ.get('CATALOG_FILE', os.path.join(repo_dir, 'catalog.json')),
+        'ROLE_QUEUE_RATE': str(args.role_rate),
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+    sys.path.insert(0, repo_dir)
+    import main as bot_module
+    main = bot_module
+
+    if args.trace_memory:
+        tracemalloc.start()
+    results = asyncio.run(run(args))
+
+    previous = load_previous_results(args.results)
+    revision = git_revision()
+    regressed = False
+    with open(args.results, 'a') as f:
+        for result in results:
+            result['timestamp'] = datetime.now().isoformat(timespec='seconds')
+            result['revision'] = revision
+            f.write(json.dumps(result) + '\n')
+
+            baseline = previous.get((result['scenario'], json.dumps(result['params'], sort_keys=True)))
+            regressions = find_regressions(result, baseline, args.tolerance) if baseline else []
+            regressed = regressed or bool(regressions)
+            if result.get('failures'):
+                regressions.append(f"{result['failures']} correctness failures")
+                regressed = True
+            print(f"{result['scenario']:<13} n={result['count']:<6} {result['throughput_per_s']:>9}/s  "
+                  f"p50={result['p50_ms']}ms  p99={result['p99_ms']}ms  rss={result['max_rss_mb']}MB"
+                  + (f"  REGRESSION: {', '.join(regressions)}" if regressions else ''))
+            print(f"{'':<13} {json.dumps({k: v for k, v in result.items() if k not in ('scenario', 'count', 'throughput_per_s', 'p50_ms', 'p99_ms', 'max_rss_mb', 'timestamp', 'revision')})}")
+
+    if (args.check and regressed) or any(result.get('failures') for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,19 +1,28 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # Reference point for the startup phase timings
+
 import discord
 from discord.ext import commands, tasks
-import requests
+import aiohttp
 import asyncio
 import base64
-import time
+import hashlib
+import hmac
+import random
 from dotenv import load_dotenv
 import os
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from datetime import datetime, timedelta
 import json
+import gzip
+import heapq
+import logging
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
 
 # Load environment variables
 load_dotenv()
@@ -28,9 +37,240 @@ GUILD_ID = int(os.getenv('GUILD_ID'))
 PROJECT_ID = os.getenv('PROJECT_ID')
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
+MIDTRANS_TIMEOUT = float(os.getenv('MIDTRANS_TIMEOUT', 15))  # seconds per request
+MIDTRANS_MAX_CONCURRENCY = int(os.getenv('MIDTRANS_MAX_CONCURRENCY', 20))
+MIDTRANS_MAX_RETRIES = int(os.getenv('MIDTRANS_MAX_RETRIES', 3))
+MIDTRANS_RETRY_BACKOFF = float(os.getenv('MIDTRANS_RETRY_BACKOFF', 0.5))  # seconds, doubled per attempt
+# The status API lives on the Core API host of the same environment as the charge endpoint
+MIDTRANS_API_HOST = 'api.sandbox.midtrans.com' if 'sandbox' in (MIDTRANS_ENDPOINT or '') else 'api.midtrans.com'
+MIDTRANS_STATUS_URL = os.getenv('MIDTRANS_STATUS_URL', f'https://{MIDTRANS_API_HOST}/v2/{{order_id}}/status')
+RECONCILE_MIN_AGE = float(os.getenv('RECONCILE_MIN_AGE', 300))  # seconds a pending order waits for its webhook first
+RECONCILE_MIN_INTERVAL = float(os.getenv('RECONCILE_MIN_INTERVAL', 60))  # seconds between checks of a fresh order
+RECONCILE_MAX_INTERVAL = float(os.getenv('RECONCILE_MAX_INTERVAL', 3600))  # cap for old orders
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', 5))
+RECONCILE_GIVE_UP_HOURS = float(os.getenv('RECONCILE_GIVE_UP_HOURS', 48))  # unknown to Midtrans after this long: expired
+SHEET_BATCH_SIZE = int(os.getenv('SHEET_BATCH_SIZE', 50))  # rows buffered before an early flush
+SHEET_FLUSH_INTERVAL = float(os.getenv('SHEET_FLUSH_INTERVAL', 5))  # seconds between flushes
+SHEET_SPOOL_FILE = os.getenv('SHEET_SPOOL_FILE', 'sheet_spool.jsonl')
+DB_FILE = os.getenv('DB_FILE', 'data.db')
+LEGACY_DATA_FILE = 'data.json'
+CATALOG_FILE = os.getenv('CATALOG_FILE', 'catalog.json')  # products offered by !beli
+CATALOG_RELOAD_INTERVAL = float(os.getenv('CATALOG_RELOAD_INTERVAL', 5))  # seconds between checks for catalog edits
+GOOGLE_CACHE_DIR = os.getenv('GOOGLE_CACHE_DIR', '.cache')  # service account and discovery document cache
+ROLE_QUEUE_WORKERS = int(os.getenv('ROLE_QUEUE_WORKERS', 4))
+ROLE_QUEUE_RATE = float(os.getenv('ROLE_QUEUE_RATE', 5))  # role mutations per second, shared by all workers
+ROLE_QUEUE_MAX_RETRIES = int(os.getenv('ROLE_QUEUE_MAX_RETRIES', 3))
+ROLE_QUEUE_PROGRESS_EVERY = int(os.getenv('ROLE_QUEUE_PROGRESS_EVERY', 100))  # log progress every N mutations
+ANNOUNCE_CHANNEL_IDS = [int(channel_id) for channel_id in os.getenv('ANNOUNCE_CHANNEL_IDS', '').split(',') if channel_id.strip()]  # empty: every text channel
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 10))  # announcement messages per second
+ROLE_REMOVAL_RETRY_DELAY = float(os.getenv('ROLE_REMOVAL_RETRY_DELAY', 60))  # seconds before retrying a failed removal
+ROLE_GRANT_RETRY_INTERVAL = float(os.getenv('ROLE_GRANT_RETRY_INTERVAL', 600))  # seconds between retries of unfinished paid grants
+INBOX_RETRY_INTERVAL = float(os.getenv('INBOX_RETRY_INTERVAL', 30))  # seconds before retrying failed webhook events
+SESSION_TIMEOUT = 60.0  # seconds a !beli step waits for the user's reply
+SESSION_REAP_INTERVAL = 1.0  # seconds between session expiry sweeps
+INBOX_BATCH_SIZE = 100  # inbox events handled per pass
+INBOX_POLL_INTERVAL = float(os.getenv('INBOX_POLL_INTERVAL', 1.0))  # seconds between inbox polls for other processes' events
+RUN_MODE = os.getenv('RUN_MODE', 'all')  # 'all' (bot + HTTP), 'bot' (gateway only) or 'web' (HTTP workers only)
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', 1))  # uvicorn worker processes in 'web' mode
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))  # /metrics of the gateway process in 'bot' mode
+REGISTRATION_TTL_HOURS = float(os.getenv('REGISTRATION_TTL_HOURS', 24))  # idle registrations kept in memory
+MAX_REGISTRATIONS_IN_MEMORY = int(os.getenv('MAX_REGISTRATIONS_IN_MEMORY', 10000))
+ORDER_ARCHIVE_DAYS = int(os.getenv('ORDER_ARCHIVE_DAYS', 90))  # settled/canceled orders older than this are archived
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 3600))  # seconds between retention sweeps
+RETENTION_BATCH_SIZE = 1000  # orders archived per transaction
+INBOX_RETENTION_DAYS = int(os.getenv('INBOX_RETENTION_DAYS', 30))  # processed events kept for deduplication
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json' (one JSON object per line)
+EVENT_LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag probes
+
+# Logging setup
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+log_handler = logging.StreamHandler()
+if LOG_FORMAT == 'json':
+    log_handler.setFormatter(JsonLogFormatter())
+else:
+    log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+logger = logging.getLogger('payment_bot')
+
+# Metrics, rendered in the Prometheus text format by the /metrics endpoint
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.total}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+class LabeledGauge:
+    # Reads its values from a dict owned by the code that updates them
+    def __init__(self, name, help_text, label, values):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = values
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_value, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+MIDTRANS_LATENCY = Histogram('midtrans_request_seconds', 'Latency of individual Midtrans API requests.')
+SHEETS_APPEND_LATENCY = Histogram('sheets_append_seconds', 'Latency of Google Sheets append requests.')
+ROLE_MUTATION_LATENCY = Histogram('role_mutation_seconds', 'Latency of Discord role grant/revoke requests.')
+WEBHOOK_LATENCY = Histogram('webhook_request_seconds', 'Time spent in the /payment-notification handler.')
+PAYMENT_EVENT_LATENCY = Histogram('payment_event_seconds', 'Time spent processing one inbox payment event.')
+EVENT_LOOP_LAG = Histogram('event_loop_lag_seconds', 'Delay of a scheduled event loop wakeup past its due time.',
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+WEBHOOK_NOTIFICATIONS = Counter('webhook_notifications_total', 'Payment notifications received, by outcome.', 'result')
+RECONCILE_CHECKS = Counter('reconcile_checks_total', 'Midtrans status queries for stale pending orders, by result.', 'result')
+ANNOUNCEMENTS = Counter('announcements_total', 'Cohort announcement deliveries, by outcome.', 'result')
+metrics = [MIDTRANS_LATENCY, SHEETS_APPEND_LATENCY, ROLE_MUTATION_LATENCY, WEBHOOK_LATENCY,
+           PAYMENT_EVENT_LATENCY, EVENT_LOOP_LAG, WEBHOOK_NOTIFICATIONS, RECONCILE_CHECKS, ANNOUNCEMENTS]
+gauges = []  # (name, help text, callable returning the current value)
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - EVENT_LOOP_LAG_INTERVAL))
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value()}")
+    return '\n'.join(lines) + '\n'
 
 # Base64 encode the Midtrans server key
 encoded_key = base64.b64encode((MIDTRANS_SERVER_KEY + ':').encode()).decode()
+# Raw key bytes for verifying notification signatures, prepared once
+signature_key_bytes = MIDTRANS_SERVER_KEY.encode()
+
+# Midtrans HTTP client: one pooled keep-alive session shared by every request,
+# created lazily because aiohttp sessions must be opened inside the event loop
+midtrans_session = None
+midtrans_semaphore = asyncio.Semaphore(MIDTRANS_MAX_CONCURRENCY)
+
+class MidtransError(Exception):
+    def __init__(self, message, status=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+def get_midtrans_session():
+    global midtrans_session
+    if midtrans_session is None or midtrans_session.closed:
+        connector = aiohttp.TCPConnector(limit=MIDTRANS_MAX_CONCURRENCY, keepalive_timeout=60)
+        midtrans_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=MIDTRANS_TIMEOUT),
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json",
+                "Authorization": f"Basic {encoded_key}"
+            },
+        )
+    return midtrans_session
+
+async def midtrans_request(method, url, payload=None):
+    session = get_midtrans_session()
+    for attempt in range(MIDTRANS_MAX_RETRIES + 1):
+        try:
+            async with midtrans_semaphore:
+                with MIDTRANS_LATENCY.time():
+                    async with session.request(method, url, json=payload) as response:
+                        text = await response.text()
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = {"raw": text}
+            if response.status >= 400:
+                # Only throttling and server errors are worth retrying
+                retryable = response.status == 429 or response.status >= 500
+                raise MidtransError(f"Midtrans HTTP {response.status}: {data}", response.status, retryable)
+            return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # A charge that timed out or lost its connection mid-flight may
+            # already exist, and retrying it fails on the duplicate order_id.
+            # Only status reads, or charges that never reached Midtrans, are retried
+            sent = not isinstance(e, aiohttp.ClientConnectorError)
+            error = MidtransError(f"Midtrans request failed: {e!r}", retryable=method == 'GET' or not sent)
+        except MidtransError as e:
+            error = e
+        if not error.retryable or attempt == MIDTRANS_MAX_RETRIES:
+            raise error
+        delay = MIDTRANS_RETRY_BACKOFF * (2 ** attempt) * (1 + random.random())
+        logger.warning(f"Midtrans request gagal ({error}), mencoba lagi dalam {delay:.2f} detik...")
+        await asyncio.sleep(delay)
+
+async def close_midtrans_session():
+    if midtrans_session is not None and not midtrans_session.closed:
+        await midtrans_session.close()
 
 # Discord bot setup
 intents = discord.Intents.default()
@@ -38,35 +278,567 @@ intents.members = True
 intents.message_content = True
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+# Compact in-memory records; __slots__ avoids a per-instance dict, which
+# matters once a few cohorts worth of registrations and orders are loaded
+class Registration:
+    __slots__ = ('email', 'name', 'phone', 'member_name', 'last_active')
+
+    def __init__(self, email=None, name=None, phone=None, member_name=None, last_active=None):
+        self.email = email
+        self.name = name
+        self.phone = phone
+        self.member_name = member_name  # Store only the name instead of Member objects
+        self.last_active = last_active if last_active is not None else time.time()
+
+class Order:
+    __slots__ = ('user_id', 'role', 'status', 'created_at')
+
+    def __init__(self, user_id, role, status, created_at=None):
+        self.user_id = user_id
+        self.role = role
+        self.status = status
+        self.created_at = created_at if created_at is not None else time.time()
+
+    def __repr__(self):
+        return f"Order(user_id={self.user_id}, role={self.role!r}, status={self.status!r})"
+
+def order_created_at(order_id):
+    # Orders from before created_at was stored carry their timestamp in the id
+    try:
+        return float(order_id.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return time.time()
+
 # Global variables
-user_emails = {}
-user_names = {}
-user_phone_numbers = {}
-payment_status = {}
+registrations = OrderedDict()  # user_id -> Registration, least recently active first
 role_expiry = {}
-user_members = {}  # Store user ID and name instead of Member objects
 
-# Google Sheets setup
-def load_serviceaccount(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()
+# Persistent storage. The records above are the in-memory working set; every
+# mutation is also written straight to SQLite so nothing is lost on a crash
+class SQLiteStore:
+    USER_FIELDS = ('email', 'name', 'phone', 'member_name')
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                email TEXT,
+                name TEXT,
+                phone TEXT,
+                member_name TEXT
+            );
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                role TEXT,
+                status TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS orders_user_id ON orders (user_id);
+            CREATE INDEX IF NOT EXISTS orders_status ON orders (status);
+            CREATE TABLE IF NOT EXISTS role_expiry (
+                user_id INTEGER PRIMARY KEY,
+                role_name TEXT,
+                expiry_time REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS role_grants (
+                order_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                role_name TEXT NOT NULL,
+                duration_days REAL NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                order_id TEXT NOT NULL,
+                transaction_status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                received_at REAL NOT NULL,
+                processed_at REAL,
+                PRIMARY KEY (order_id, transaction_status)
+            );
+            CREATE INDEX IF NOT EXISTS webhook_inbox_unprocessed ON webhook_inbox (received_at) WHERE processed_at IS NULL;
+        """)
+        self._add_column('users', 'last_active', 'REAL')
+        self._add_column('orders', 'created_at', 'REAL')
+        self._add_column('role_expiry', 'role_id', 'INTEGER')
+
+    def _add_column(self, table, column, declaration):
+        # Columns added after the first release of a table
+        columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+    def set_user_field(self, user_id, field, value):
+        if field not in self.USER_FIELDS:
+            raise ValueError(f"Unknown user field: {field}")
+        self.conn.execute(
+            f"INSERT INTO users (user_id, {field}, last_active) VALUES (?, ?, ?) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {field} = excluded.{field}, last_active = excluded.last_active",
+            (user_id, value, time.time()))
+
+    def get_user(self, user_id):
+        row = self.conn.execute(
+            "SELECT email, name, phone, member_name, last_active FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        return Registration(row[0], row[1], row[2], row[3], row[4] or 0)
+
+    def delete_users(self, user_ids):
+        self.conn.executemany("DELETE FROM users WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+    def user_has_orders(self, user_id):
+        return self.conn.execute("SELECT 1 FROM orders WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is not None
+
+    def clear_user_fields(self, user_id, fields):
+        for field in fields:
+            if field not in self.USER_FIELDS:
+                raise ValueError(f"Unknown user field: {field}")
+        assignments = ', '.join(f"{field} = NULL" for field in fields)
+        self.conn.execute(f"UPDATE users SET {assignments} WHERE user_id = ?", (user_id,))
+
+    def save_order(self, order_id, order):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO orders (order_id, user_id, role, status, created_at) VALUES (?, ?, ?, ?, ?)",
+            (order_id, order.user_id, order.role, order.status, order.created_at))
+
+    def get_order(self, order_id):
+        row = self.conn.execute(
+            "SELECT user_id, role, status, created_at FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        if row is None:
+            return None
+        return Order(row[0], row[1], row[2], row[3] or order_created_at(order_id))
+
+    def archivable_orders(self, created_before, limit):
+        return self.conn.execute(
+            "SELECT order_id, user_id, role, status, created_at FROM orders "
+            "WHERE status IN ('settled', 'canceled', 'expired') AND COALESCE(created_at, 0) < ? LIMIT ?",
+            (created_before, limit)).fetchall()
+
+    def delete_orders(self, order_ids):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany("DELETE FROM orders WHERE order_id = ?", [(order_id,) for order_id in order_ids])
+
+    def set_order_status(self, order_id, status):
+        self.conn.execute("UPDATE orders SET status = ? WHERE order_id = ?", (status, order_id))
+
+    def set_role_expiry(self, user_id, role_name, expiry_time, role_id=None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO role_expiry (user_id, role_name, expiry_time, role_id) VALUES (?, ?, ?, ?)",
+            (user_id, role_name, expiry_time, role_id))
+
+    def delete_role_expiry(self, user_id):
+        self.conn.execute("DELETE FROM role_expiry WHERE user_id = ?", (user_id,))
+
+    def add_role_grant(self, order_id, user_id, role_name, duration_days):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO role_grants (order_id, user_id, role_name, duration_days, created_at) "
+            "VALUES (?, ?, ?, ?, ?)", (order_id, user_id, role_name, duration_days, time.time()))
+
+    def delete_role_grant(self, order_id):
+        self.conn.execute("DELETE FROM role_grants WHERE order_id = ?", (order_id,))
+
+    def pending_role_grants(self, user_id=None):
+        query = "SELECT order_id, user_id, role_name, duration_days FROM role_grants"
+        if user_id is None:
+            return self.conn.execute(query + " ORDER BY created_at").fetchall()
+        return self.conn.execute(query + " WHERE user_id = ? ORDER BY created_at", (user_id,)).fetchall()
+
+    def role_grant_backlog(self):
+        return self.conn.execute("SELECT COUNT(*) FROM role_grants").fetchone()[0]
+
+    def add_inbox_event(self, order_id, transaction_status, payload):
+        # Returns False when this (order_id, transaction_status) was already received
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO webhook_inbox (order_id, transaction_status, payload, received_at) VALUES (?, ?, ?, ?)",
+            (order_id, transaction_status, payload, time.time()))
+        return cursor.rowcount == 1
+
+    def unprocessed_inbox_events(self, limit=INBOX_BATCH_SIZE):
+        return self.conn.execute(
+            "SELECT order_id, transaction_status, payload FROM webhook_inbox "
+            "WHERE processed_at IS NULL ORDER BY received_at LIMIT ?", (limit,)).fetchall()
+
+    def mark_inbox_processed(self, order_id, transaction_status):
+        self.conn.execute(
+            "UPDATE webhook_inbox SET processed_at = ? WHERE order_id = ? AND transaction_status = ?",
+            (time.time(), order_id, transaction_status))
+
+    def inbox_backlog(self):
+        return self.conn.execute("SELECT COUNT(*) FROM webhook_inbox WHERE processed_at IS NULL").fetchone()[0]
+
+    def prune_inbox(self, older_than):
+        return self.conn.execute(
+            "DELETE FROM webhook_inbox WHERE processed_at IS NOT NULL AND processed_at < ?", (older_than,)).rowcount
+
+    def is_empty(self):
+        for table in ('users', 'orders', 'role_expiry'):
+            if self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def import_snapshot(self, data):
+        # One-off import of the old data.json layout (JSON object keys are strings)
+        with self.conn:
+            self.conn.execute('BEGIN')
+            for field, key in (('email', 'user_emails'), ('name', 'user_names'),
+                               ('phone', 'user_phone_numbers'), ('member_name', 'user_members')):
+                for user_id, value in data.get(key, {}).items():
+                    self.set_user_field(int(user_id), field, value)
+            for order_id, order in data.get('payment_status', {}).items():
+                self.save_order(order_id, Order(order['user_id'], order['role'], order['status'], order_created_at(order_id)))
+            for user_id, (role_name, expiry_time) in data.get('role_expiry', {}).items():
+                self.set_role_expiry(int(user_id), role_name, expiry_time)
+
+    def load(self, active_since):
+        # Only recently active users and users with a pending order are loaded;
+        # anyone else is read back on demand through get_user
+        data = {'registrations': OrderedDict(), 'payment_status': {}, 'role_expiry': {}}
+        for user_id, email, name, phone, member_name, last_active in self.conn.execute(
+                "SELECT user_id, email, name, phone, member_name, COALESCE(last_active, 0) FROM users "
+                "WHERE COALESCE(last_active, 0) >= ? "
+                "OR user_id IN (SELECT user_id FROM orders WHERE status = 'pending') "
+                "ORDER BY COALESCE(last_active, 0)", (active_since,)):
+            data['registrations'][user_id] = Registration(email, name, phone, member_name, last_active)
+        for order_id, user_id, role, status, created_at in self.conn.execute(
+                "SELECT order_id, user_id, role, status, created_at FROM orders"):
+            data['payment_status'][order_id] = Order(user_id, role, status, created_at or order_created_at(order_id))
+        for user_id, role_id, role_name, expiry_time in self.conn.execute(
+                "SELECT user_id, role_id, role_name, expiry_time FROM role_expiry"):
+            data['role_expiry'][user_id] = (role_id, role_name, expiry_time)
+        return data
+
+    def close(self):
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.close()
+
+store = SQLiteStore(DB_FILE)
+
+# Orders keyed by order_id, with secondary indexes (user_id -> order_ids,
+# status -> order_ids) kept in sync on every transition. Dicts are used as
+# ordered sets so order_ids keep their creation order
+class OrderRegistry:
+    def __init__(self, store):
+        self.store = store
+        self.orders = {}
+        self.by_user = {}
+        self.by_status = {}
+
+    def __contains__(self, order_id):
+        return order_id in self.orders
+
+    def __getitem__(self, order_id):
+        return self.orders[order_id]
 
-service_account_json = load_serviceaccount(JSON_FILE_URL)
+    def __len__(self):
+        return len(self.orders)
+
+    def __repr__(self):
+        return repr(self.orders)
+
+    def get(self, order_id, default=None):
+        return self.orders.get(order_id, default)
+
+    def _index(self, order_id, order):
+        self.by_user.setdefault(order.user_id, {})[order_id] = None
+        self.by_status.setdefault(order.status, {})[order_id] = None
+
+    def _unindex(self, index, key, order_id):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(order_id, None)
+            if not bucket:
+                del index[key]
+
+    def load(self, orders):
+        self.orders = {}
+        self.by_user = {}
+        self.by_status = {}
+        for order_id, order in orders.items():
+            self.cache(order_id, order)
+
+    def cache(self, order_id, order):
+        # Track an order that is already persisted
+        self.orders[order_id] = order
+        self._index(order_id, order)
+
+    def add(self, order_id, order):
+        self.orders[order_id] = order
+        self._index(order_id, order)
+        self.store.save_order(order_id, order)
+
+    def set_status(self, order_id, status):
+        order = self.orders[order_id]
+        if order.status == status:
+            return
+        self._unindex(self.by_status, order.status, order_id)
+        order.status = status
+        self.by_status.setdefault(status, {})[order_id] = None
+        self.store.set_order_status(order_id, status)
+
+    def remove(self, order_id):
+        # Forget an order in memory only, e.g. once it has been archived
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self._unindex(self.by_user, order.user_id, order_id)
+            self._unindex(self.by_status, order.status, order_id)
+
+    def has_pending(self, user_id):
+        return any(self.orders[order_id].status == 'pending' for order_id in self.by_user.get(user_id, ()))
+
+    def for_user(self, user_id):
+        return {order_id: self.orders[order_id] for order_id in self.by_user.get(user_id, ())}
+
+    def with_status(self, status):
+        return list(self.by_status.get(status, ()))
+
+payment_status = OrderRegistry(store)
+
+def touch_registration(user_id):
+    registration = registrations.get(user_id)
+    if registration is None:
+        registration = store.get_user(user_id) or Registration()
+        registrations[user_id] = registration
+    else:
+        registrations.move_to_end(user_id)
+    registration.last_active = time.time()
+    return registration
+
+def get_registration(user_id):
+    # Registrations evicted from memory are read back from the store
+    return registrations.get(user_id) or store.get_user(user_id)
+
+# Retention. Idle registrations leave memory after REGISTRATION_TTL_HOURS (or
+# earlier, least recently active first, past MAX_REGISTRATIONS_IN_MEMORY);
+# the partial data of abandoned !beli sessions is dropped from the store as
+# well. Settled, canceled and expired orders older than ORDER_ARCHIVE_DAYS move to
+# gzipped JSONL files in ARCHIVE_DIR, one per month of archival, and processed
+# webhook inbox rows are deleted after INBOX_RETENTION_DAYS
+def evict_registrations(now):
+    cutoff = now - REGISTRATION_TTL_HOURS * 60 * 60
+    evicted = 0
+    abandoned = []
+    for user_id in list(registrations):
+        registration = registrations[user_id]
+        if registration.last_active >= cutoff and len(registrations) <= MAX_REGISTRATIONS_IN_MEMORY:
+            break  # Everything after this one is more recent
+        if payment_status.has_pending(user_id):
+            continue
+        del registrations[user_id]
+        evicted += 1
+        if registration.last_active < cutoff and user_id not in payment_status.by_user and not store.user_has_orders(user_id):
+            abandoned.append(user_id)
+    store.delete_users(abandoned)
+    return evicted, len(abandoned)
+
+async def archive_orders(now):
+    archived = 0
+    while True:
+        rows = store.archivable_orders(now - ORDER_ARCHIVE_DAYS * 24 * 60 * 60, RETENTION_BATCH_SIZE)
+        if not rows:
+            return archived
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        archive_file = os.path.join(ARCHIVE_DIR, f"orders-{datetime.now().strftime('%Y-%m')}.jsonl.gz")
+        with gzip.open(archive_file, 'at') as f:
+            for row in rows:
+                f.write(json.dumps(row, separators=(',', ':')) + '\n')
+        order_ids = [row[0] for row in rows]
+        store.delete_orders(order_ids)
+        for order_id in order_ids:
+            payment_status.remove(order_id)
+        archived += len(rows)
+        await asyncio.sleep(0)  # Let other tasks run between batches
+
+async def run_retention_sweep():
+    now = time.time()
+    # Evict first: a user whose orders are about to be archived is not abandoned
+    evicted, abandoned = evict_registrations(now)
+    archived = await archive_orders(now)
+    pruned = store.prune_inbox(now - INBOX_RETENTION_DAYS * 24 * 60 * 60)
+    if archived or evicted or pruned:
+        logger.info(f"Retensi: {archived} order diarsipkan, {evicted} registrasi dikeluarkan dari memori "
+                    f"({abandoned} sesi terbengkalai dihapus), {pruned} notifikasi lama dihapus.")
+
+async def retention_sweeper():
+    await data_loaded.wait()
+    while True:
+        try:
+            await run_retention_sweep()
+        except Exception as e:
+            logger.error(f"Terjadi kesalahan saat menjalankan retensi data: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# Startup phase timings, measured from the first line of this module
+startup_phases = {}
+
+def mark_startup_phase(phase):
+    if phase in startup_phases:
+        return
+    startup_phases[phase] = time.perf_counter() - STARTUP_STARTED
+    logger.info(f"Startup: {phase} setelah {startup_phases[phase]:.3f} detik")
+
+# Google Sheets setup. The client is built on first use, off the event loop,
+# from a service account and discovery document cached on local disk, so
+# importing this module never waits on the network. The Google client
+# libraries are imported there too; they are a noticeable share of import time
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-credentials = service_account.Credentials.from_service_account_info(service_account_json, scopes=SCOPES)
-service = build('sheets', 'v4', credentials=credentials)
+SHEETS_DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+SERVICE_ACCOUNT_CACHE = os.path.join(GOOGLE_CACHE_DIR, 'service_account.json')
+DISCOVERY_CACHE = os.path.join(GOOGLE_CACHE_DIR, 'sheets_v4_discovery.json')
+
+service = None
+sheets_service_lock = asyncio.Lock()
+
+def fetch_cached(url, cache_file, private=False):
+    try:
+        with open(cache_file, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    import requests
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    os.makedirs(GOOGLE_CACHE_DIR, exist_ok=True)
+    tmp_file = cache_file + '.tmp'
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 if private else 0o644)
+    with os.fdopen(fd, 'w') as f:
+        f.write(response.text)
+    os.replace(tmp_file, cache_file)
+    return response.text
+
+def load_serviceaccount(url):
+    return json.loads(fetch_cached(url, SERVICE_ACCOUNT_CACHE, private=True))
 
-# Function to write data to Google Sheets
+def build_sheets_service():
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build_from_document
+    service_account_json = load_serviceaccount(JSON_FILE_URL)
+    credentials = service_account.Credentials.from_service_account_info(service_account_json, scopes=SCOPES)
+    discovery_document = fetch_cached(SHEETS_DISCOVERY_URL, DISCOVERY_CACHE)
+    return build_from_document(discovery_document, credentials=credentials)
+
+async def get_sheets_service():
+    global service
+    if service is None:
+        async with sheets_service_lock:
+            if service is None:
+                started = time.perf_counter()
+                service = await asyncio.to_thread(build_sheets_service)
+                logger.info(f"Google Sheets client siap dalam {time.perf_counter() - started:.3f} detik")
+    return service
+
+def invalidate_sheets_credentials():
+    # The cached key was rotated or revoked: drop it so the next flush re-fetches it
+    global service
+    service = None
+    try:
+        os.remove(SERVICE_ACCOUNT_CACHE)
+    except FileNotFoundError:
+        pass
+
+async def warm_up_sheets_service():
+    # Build the client in the background so the first flush does not pay for it
+    try:
+        await get_sheets_service()
+    except Exception as e:
+        logger.warning(f"Google Sheets client belum bisa dibuat, akan dicoba lagi saat flush: {e}")
+
+# Google Sheets write-behind queue. Rows are spooled to disk first so they
+# survive a crash, then appended in batches (one request per sheet) by sheet_writer
+sheet_rows = []
+sheet_flush_event = asyncio.Event()
+sheet_flush_lock = asyncio.Lock()
+
+def rewrite_sheet_spool():
+    tmp_file = SHEET_SPOOL_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        for row in sheet_rows:
+            f.write(json.dumps(row) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, SHEET_SPOOL_FILE)
+
+def load_sheet_spool():
+    try:
+        with open(SHEET_SPOOL_FILE, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    sheet_rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Baris spool Google Sheets rusak dilewati: {line!r}")
+    except FileNotFoundError:
+        return
+    if sheet_rows:
+        logger.info(f"{len(sheet_rows)} baris Google Sheets dimuat dari spool.")
+        sheet_flush_event.set()
+
+# Function to queue data for Google Sheets
 def gsheet(user_id, email, name, phone, role_name, order_id, payment_status, sheet_name):
-    values = [
-        [user_id, email, name, phone, role_name, order_id, payment_status, datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
-    ]
+    row = {
+        "sheet": sheet_name,
+        "values": [user_id, email, name, phone, role_name, order_id, payment_status, datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+    }
+    with open(SHEET_SPOOL_FILE, 'a') as f:
+        f.write(json.dumps(row) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    sheet_rows.append(row)
+    if len(sheet_rows) >= SHEET_BATCH_SIZE:
+        sheet_flush_event.set()
+
+def append_sheet_rows(service, sheet_name, values):
     body = {'values': values}
     result = service.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID, range=f'{sheet_name}!A1',
-        valueInputOption='RAW', body=body).execute()
-    print(f"{result.get('updates').get('updatedCells')} cells appended.")
+        valueInputOption='RAW', insertDataOption='INSERT_ROWS', body=body).execute()
+    logger.info(f"{result.get('updates').get('updatedCells')} cells appended to {sheet_name}.")
+
+async def flush_sheet_rows():
+    async with sheet_flush_lock:
+        if not sheet_rows:
+            return
+        try:
+            service = await get_sheets_service()
+        except Exception as e:
+            logger.warning(f"Google Sheets client belum bisa dibuat, akan dicoba lagi: {e}")
+            return
+        from google.auth.exceptions import RefreshError
+        batch = list(sheet_rows)
+        grouped = {}
+        for row in batch:
+            grouped.setdefault(row['sheet'], []).append(row['values'])
+
+        flushed_sheets = set()
+        for sheet_name, values in grouped.items():
+            try:
+                with SHEETS_APPEND_LATENCY.time():
+                    await asyncio.to_thread(append_sheet_rows, service, sheet_name, values)
+                flushed_sheets.add(sheet_name)
+            except RefreshError as e:
+                logger.warning(f"Kredensial Google ditolak, service account akan diunduh ulang: {e}")
+                invalidate_sheets_credentials()
+                break
+            except Exception as e:
+                logger.warning(f"Gagal menulis {len(values)} baris ke sheet {sheet_name}, akan dicoba lagi: {e}")
+
+        # Rows queued while the flush was running stay in sheet_rows
+        flushed = {id(row) for row in batch if row['sheet'] in flushed_sheets}
+        sheet_rows[:] = [row for row in sheet_rows if id(row) not in flushed]
+        rewrite_sheet_spool()
+
+async def sheet_writer():
+    while True:
+        try:
+            await asyncio.wait_for(sheet_flush_event.wait(), timeout=SHEET_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        sheet_flush_event.clear()
+        await flush_sheet_rows()
 
 # Registration period and class duration
 START_REGISTRATION_DATE = datetime(2024, 12, 25)  
@@ -76,15 +848,283 @@ CLASS_DURATION_DAYS = 30
 # Calculate end class date
 END_CLASS_DATE = START_REGISTRATION_DATE + timedelta(days=CLASS_DURATION_DAYS) 
 
+# Spaces requests evenly so that a burst stays within a requests-per-second budget
+class RatePacer:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = 0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+# Role mutation queue. Grants and revocations for the same (member, role)
+# collapse into the latest requested action, and a small worker pool drains
+# the queue at ROLE_QUEUE_RATE so a cohort rollover cannot starve the
+# role endpoints that every other bot action shares. submit() returns a
+# future that resolves to True once the mutation was applied
+class RoleMutationQueue:
+    def __init__(self, workers, rate, max_retries):
+        self.workers = workers
+        self.pacer = RatePacer(rate)
+        self.max_retries = max_retries
+        self.pending = {}  # (member_id, role_id) -> [action, member, role, future, attempts, still_wanted]
+        self.queue = asyncio.Queue()
+        self.inflight = 0
+        self.tasks = []
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.batch_started = None
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def depth(self):
+        return len(self.pending) + self.inflight
+
+    # The future resolves to True once applied, False if it failed, and None
+    # if still_wanted() said no (checked on submit and again right before the
+    # request) or a newer, different action replaced it
+    def submit(self, member, role, action, still_wanted=None):
+        future = asyncio.get_running_loop().create_future()
+        if still_wanted is not None and not still_wanted():
+            future.set_result(None)
+            return future
+        key = (member.id, role.id)
+        op = self.pending.get(key)
+        if op is not None:
+            # Only the most recent action matters; the older one is dropped
+            self.deduplicated += 1
+            if not op[3].done():
+                if op[0] == action:
+                    future.add_done_callback(lambda newer, older=op[3]: older.done() or older.set_result(newer.result()))
+                else:
+                    op[3].set_result(None)
+            op[0], op[1], op[3], op[4], op[5] = action, member, future, 0, still_wanted
+            return future
+        if self.batch_started is None:
+            self.batch_started = time.perf_counter()
+        self.pending[key] = [action, member, role, future, 0, still_wanted]
+        self.queue.put_nowait(key)
+        return future
+
+    async def _apply(self, op):
+        action, member, role, future, attempts, still_wanted = op
+        verb = 'menambahkan' if action == 'add' else 'menghapus'
+        await self.pacer.wait()
+        if still_wanted is not None and not still_wanted():
+            return 'skipped'  # e.g. a role renewed while its expiry removal was queued
+        try:
+            with ROLE_MUTATION_LATENCY.time():
+                if action == 'add':
+                    await member.add_roles(role)
+                else:
+                    await member.remove_roles(role)
+        except discord.Forbidden:
+            logger.warning(f"Bot tidak memiliki izin untuk {verb} role {role.name} untuk {member.name} (ID: {member.id}).")
+        except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            key = (member.id, role.id)
+            # Retry unless a newer action for the same member and role was queued meanwhile
+            if attempts < self.max_retries and key not in self.pending:
+                op[4] = attempts + 1
+                self.pending[key] = op
+                delay = 2 ** attempts
+                logger.warning(f"Gagal {verb} role {role.name} untuk {member.name} (ID: {member.id}), mencoba lagi dalam {delay} detik: {e}")
+                asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, key)
+                return None
+            logger.error(f"Terjadi kesalahan saat {verb} role {role.name} untuk {member.name} (ID: {member.id}): {e}")
+            return False
+        else:
+            return True
+        return False
+
+    def _finish(self, future, ok):
+        if ok == 'skipped':
+            ok = None
+        elif ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        if not future.done():
+            future.set_result(ok)
+        done = self.completed + self.failed
+        if ROLE_QUEUE_PROGRESS_EVERY and done % ROLE_QUEUE_PROGRESS_EVERY == 0:
+            logger.info(f"Antrian role: {done} selesai, {self.depth()} tersisa.")
+        if not self.depth() and self.batch_started is not None:
+            elapsed = time.perf_counter() - self.batch_started
+            logger.info(f"Antrian role kosong: {self.completed} berhasil, {self.failed} gagal, "
+                  f"{self.deduplicated} duplikat dilewati ({elapsed:.1f} detik).")
+            self.batch_started = None
+
+    async def _worker(self):
+        while True:
+            key = await self.queue.get()
+            op = self.pending.pop(key, None)
+            if op is None:
+                continue
+            self.inflight += 1
+            try:
+                ok = await self._apply(op)
+            except Exception as e:
+                logger.error(f"Terjadi kesalahan tidak terduga di antrian role: {e}")
+                ok = False
+            finally:
+                self.inflight -= 1
+            if ok is not None:
+                self._finish(op[3], ok)
+
+role_queue = RoleMutationQueue(ROLE_QUEUE_WORKERS, ROLE_QUEUE_RATE, ROLE_QUEUE_MAX_RETRIES)
+
+# Role resolution cache. Roles are indexed by name and ID once per guild
+# snapshot, together with the set of roles that sit below the bot's top role
+# and can therefore be granted. Role events and changes to the bot's own
+# member drop the snapshot and the next lookup rebuilds it. Members other than
+# the bot are left to discord.py's own ID-keyed member cache
+class GuildCache:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.guild = None
+        self.roles_by_name = {}
+        self.roles_by_id = {}
+        self.assignable = set()
+
+    def invalidate(self):
+        self.guild = None
+
+    def get_guild(self):
+        guild = bot.get_guild(self.guild_id)
+        if guild is not None and guild is not self.guild:
+            self._build(guild)
+        return guild
+
+    def _build(self, guild):
+        roles_by_name = {}
+        for role in guild.roles:
+            roles_by_name.setdefault(role.name, role)  # First match wins, like discord.utils.get
+        bot_member = guild.get_member(bot.user.id)
+        top_position = bot_member.top_role.position if bot_member else 0
+        self.roles_by_name = roles_by_name
+        self.roles_by_id = {role.id: role for role in guild.roles}
+        self.assignable = {role.id for role in guild.roles if role.position < top_position}
+        self.guild = guild
+
+    def role(self, name):
+        return self.roles_by_name.get(name) if self.get_guild() is not None else None
+
+    def role_by_id(self, role_id, name=None):
+        # Rows saved before role IDs were stored only carry the name
+        if self.get_guild() is None:
+            return None
+        if role_id is None:
+            return self.roles_by_name.get(name)
+        return self.roles_by_id.get(role_id)
+
+    def can_assign(self, role):
+        return self.get_guild() is not None and role.id in self.assignable
+
+guild_cache = GuildCache(GUILD_ID)
+
+@bot.listen('on_guild_role_create')
+async def invalidate_on_role_create(role):
+    guild_cache.invalidate()
+
+@bot.listen('on_guild_role_update')
+async def invalidate_on_role_update(before, after):
+    guild_cache.invalidate()
+
+@bot.listen('on_guild_role_delete')
+async def invalidate_on_role_delete(role):
+    guild_cache.invalidate()
+
+@bot.listen('on_member_update')
+async def invalidate_on_bot_member_update(before, after):
+    # Only the bot's own roles decide what it may assign
+    if after.id == bot.user.id and before.roles != after.roles:
+        guild_cache.invalidate()
+
+# Role expiry scheduling: a min-heap of (expiry_time, user_id). Entries are
+# never removed from the middle of the heap; an entry is stale when
+# role_expiry no longer holds a due expiry for that user, and is skipped
+expiry_heap = []
+expiry_wakeup = asyncio.Event()
+
+def schedule_expiry(user_id, expiry_time):
+    heapq.heappush(expiry_heap, (expiry_time, user_id))
+    if expiry_heap[0] == (expiry_time, user_id):
+        expiry_wakeup.set()  # New earliest deadline, let the scheduler re-arm
+
+def rebuild_expiry_heap():
+    expiry_heap[:] = [(expiry_time, user_id) for user_id, (role, expiry_time) in role_expiry.items()]
+    heapq.heapify(expiry_heap)
+    expiry_wakeup.set()
+
+def pop_due_expiries(now):
+    due = {}
+    while expiry_heap and expiry_heap[0][0] <= now:
+        expiry_time, user_id = heapq.heappop(expiry_heap)
+        entry = role_expiry.get(user_id)
+        if entry is None or entry[1] > now:
+            continue  # Stale: removed already or renewed with a later expiry
+        due[user_id] = None
+    return list(due)
+
+async def revoke_expired_role(guild, user_id):
+    entry = role_expiry.get(user_id)
+    if entry is None or entry[1] > time.time():
+        return  # Renewed between being popped as due and getting here
+    role, expiry_time = entry
+    member = guild.get_member(user_id)
+    if member and role:
+        # Skipped if a renewal moves the expiry while the removal is queued
+        result = await role_queue.submit(member, role, 'remove',
+                                         still_wanted=lambda: role_expiry.get(user_id, (None, None))[1] == expiry_time)
+        if result is None:
+            return
+        if not result:
+            entry = role_expiry.get(user_id)
+            if entry is not None and entry[1] == expiry_time:
+                schedule_expiry(user_id, time.time() + ROLE_REMOVAL_RETRY_DELAY)
+            return
+        logger.info(f"Role {role.name} telah dihapus dari {member.name}")
+    elif role is None:
+        # Resolved by ID, so the role itself was deleted and nobody holds it any more
+        logger.warning(f"Role untuk user {user_id} sudah tidak ada di guild, expiry dihapus.")
+    if role_expiry.get(user_id, (None, None))[1] == expiry_time:  # Not renewed meanwhile
+        del role_expiry[user_id] 
+        store.delete_role_expiry(user_id)
+
 async def remove_role(guild):
-    now = time.time()  
-    for user_id, (role, expiry_time) in list(role_expiry.items()):
-        if now >= expiry_time:  
-            member = guild.get_member(user_id)
-            if member and role:
-                await member.remove_roles(role)
-                print(f"Role {role.name} telah dihapus dari {member.name}")
-            del role_expiry[user_id] 
+    due = pop_due_expiries(time.time())
+    # The role queue paces the actual requests, so everything due is submitted at once
+    await asyncio.gather(*(revoke_expired_role(guild, user_id) for user_id in due))
+
+async def role_expiry_scheduler():
+    await bot.wait_until_ready()
+    while True:
+        expiry_wakeup.clear()
+        delay = expiry_heap[0][0] - time.time() if expiry_heap else 3600
+        if delay > 0:
+            # Re-check at least hourly in case the wall clock jumped
+            try:
+                await asyncio.wait_for(expiry_wakeup.wait(), timeout=min(delay, 3600))
+            except asyncio.TimeoutError:
+                pass
+            continue
+        guild = bot.get_guild(GUILD_ID)
+        if guild is None:
+            await asyncio.sleep(ROLE_REMOVAL_RETRY_DELAY)
+            continue
+        await remove_role(guild)
 
 @tasks.loop(hours=24)
 async def schedule_role_removal():
@@ -93,44 +1133,138 @@ async def schedule_role_removal():
     
     if now >= END_CLASS_DATE: 
         guild = bot.get_guild(GUILD_ID)
-        await remove_role(guild)
         
         START_REGISTRATION_DATE = END_CLASS_DATE + timedelta(days=1) 
         END_CLASS_DATE = START_REGISTRATION_DATE + timedelta(days=CLASS_DURATION_DAYS)  
         
-        for channel in guild.text_channels:
-            await channel.send(f"📅 Pendaftaran untuk kelas baru dibuka! Mulai dari {START_REGISTRATION_DATE.strftime('%d-%m-%Y')} hingga {START_REGISTRATION_DATE + timedelta(days=REGISTRATION_PERIOD_DAYS)}.")
+        # The announcement goes out while the expired roles are being revoked
+        await asyncio.gather(
+            remove_role(guild),
+            broadcast(guild, f"📅 Pendaftaran untuk kelas baru dibuka! Mulai dari {START_REGISTRATION_DATE.strftime('%d-%m-%Y')} hingga {START_REGISTRATION_DATE + timedelta(days=REGISTRATION_PERIOD_DAYS)}."),
+        )
+
+# Announcements. Channels are sent to concurrently, BROADCAST_CONCURRENCY at a
+# time and paced at BROADCAST_RATE; returns channel_id -> delivery result
+async def broadcast(guild, content):
+    if ANNOUNCE_CHANNEL_IDS:
+        channels = [guild.get_channel(channel_id) for channel_id in ANNOUNCE_CHANNEL_IDS]
+        channels = [channel for channel in channels if channel is not None]
+    else:
+        channels = list(guild.text_channels)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    pacer = RatePacer(BROADCAST_RATE)
+    deliveries = {}
 
+    async def deliver(channel):
+        async with semaphore:
+            for attempt in range(2):
+                await pacer.wait()
+                try:
+                    await channel.send(content)
+                    deliveries[channel.id] = 'sent'
+                    break
+                except discord.Forbidden:
+                    deliveries[channel.id] = 'forbidden'
+                    break
+                except discord.HTTPException as e:
+                    deliveries[channel.id] = f'failed: {e}'
+                except Exception as e:
+                    # Transport errors must not abort the other channels or the revocations
+                    deliveries[channel.id] = f'failed: {e!r}'
+        ANNOUNCEMENTS.inc(deliveries[channel.id].split(':')[0])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(deliver(channel) for channel in channels))
+    elapsed = time.perf_counter() - started
+    sent = sum(1 for result in deliveries.values() if result == 'sent')
+    logger.info(f"Pengumuman terkirim ke {sent}/{len(channels)} channel dalam {elapsed:.1f} detik.")
+    for channel_id, result in deliveries.items():
+        if result != 'sent':
+            logger.warning(f"Pengumuman ke channel {channel_id} tidak terkirim: {result}")
+    return deliveries
+
+def record_role_expiry(user_id, role, expiry_time):
+    role_expiry[user_id] = (role, expiry_time)
+    store.set_role_expiry(user_id, role.name, expiry_time, role.id)
+    schedule_expiry(user_id, expiry_time)
+
+# Returns True once the role is granted and its expiry recorded
 async def function_role(guild, user_id, role_name, duration_days=30):
-    role = discord.utils.get(guild.roles, name=role_name)
+    role = guild_cache.role(role_name)
     member = guild.get_member(user_id)
+    if not member:
+        # Not in the member cache (e.g. chunking unfinished); ask the API
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.HTTPException:
+            member = None
     
     if not member:
-        print(f"Member dengan ID {user_id} tidak ditemukan di guild {guild.name}.")
-        return
+        logger.warning(f"Member dengan ID {user_id} tidak ditemukan di guild {guild.name}.")
+        return False
     
     if not role:
-        print(f"Role '{role_name}' tidak ditemukan di guild {guild.name}.")
-        return
+        logger.warning(f"Role '{role_name}' tidak ditemukan di guild {guild.name}.")
+        return False
     
-    bot_member = guild.get_member(bot.user.id)
-    bot_top_role = bot_member.top_role
-    if role.position >= bot_top_role.position:
-        print(f"Role '{role_name}' memiliki posisi di atas atau sama dengan role bot di guild {guild.name}.")
-        return
+    if not guild_cache.can_assign(role):
+        logger.warning(f"Role '{role_name}' memiliki posisi di atas atau sama dengan role bot di guild {guild.name}.")
+        return False
     
-    try:
-        await member.add_roles(role)
-        print(f"Role {role_name} telah ditambahkan ke {member.name} (ID: {member.id})")
-        
-        expiry_time = time.time() + duration_days * 24 * 60 * 60  
-        role_expiry[user_id] = (role, expiry_time)
-    except discord.Forbidden:
-        print(f"Bot tidak memiliki izin untuk menambahkan role {role_name} ke {member.name} (ID: {member.id}).")
-    except discord.HTTPException as e:
-        print(f"Terjadi kesalahan saat menambahkan role {role_name} ke {member.name} (ID: {member.id}): {e}")
-    except Exception as e:
-        print(f"Terjadi kesalahan tidak terduga saat menambahkan role {role_name} ke {member.name} (ID: {member.id}): {e}")
+    # The new expiry is recorded before the grant is queued, so an expiry
+    # removal still waiting in the role queue sees the renewal and is skipped
+    previous = role_expiry.get(user_id)
+    expiry_time = time.time() + duration_days * 24 * 60 * 60  
+    record_role_expiry(user_id, role, expiry_time)
+
+    # Errors are reported and retried by the role queue
+    if await role_queue.submit(member, role, 'add') is False:
+        if role_expiry.get(user_id, (None, None))[1] == expiry_time:
+            if previous is not None and previous[0] is not None:
+                record_role_expiry(user_id, *previous)
+            else:
+                del role_expiry[user_id]
+                store.delete_role_expiry(user_id)
+        return False
+    logger.info(f"Role {role_name} telah ditambahkan ke {member.name} (ID: {member.id})")
+    return True
+
+# Paid grants. A settled order first writes a role_grants row, which is only
+# deleted once the role is actually granted, so grants still waiting in the
+# in-memory role queue survive a restart. Unfinished rows are driven again at
+# startup, every ROLE_GRANT_RETRY_INTERVAL and when the member (re)joins
+role_grant_tasks = {}  # order_id -> running grant task
+
+async def drive_role_grant(order_id, user_id, role_name, duration_days):
+    guild = bot.get_guild(GUILD_ID)
+    if guild is None:
+        return
+    if await function_role(guild, user_id, role_name, duration_days):
+        store.delete_role_grant(order_id)
+    else:
+        logger.error(f"Role {role_name} untuk order {order_id} (user {user_id}) belum bisa diberikan, "
+                     f"akan dicoba lagi dalam {ROLE_GRANT_RETRY_INTERVAL:.0f} detik.")
+
+def start_role_grant(order_id, user_id, role_name, duration_days):
+    if order_id in role_grant_tasks:
+        return  # Already being granted
+    task = asyncio.create_task(drive_role_grant(order_id, user_id, role_name, duration_days))
+    role_grant_tasks[order_id] = task
+    task.add_done_callback(lambda _: role_grant_tasks.pop(order_id, None))
+
+async def role_grant_retrier():
+    await data_loaded.wait()
+    await bot.wait_until_ready()
+    while True:
+        for grant in store.pending_role_grants():
+            start_role_grant(*grant)
+        await asyncio.sleep(ROLE_GRANT_RETRY_INTERVAL)
+
+@bot.listen('on_member_join')
+async def resume_grants_on_join(member):
+    if member.guild.id == GUILD_ID:
+        for grant in store.pending_role_grants(member.id):
+            start_role_grant(*grant)
 
 # FastAPI setup
 app = FastAPI()
@@ -142,102 +1276,250 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Test link for the role
-test_link = "https://forms.gle/4caBzgzJJhhXsR5L8"
+event_loop_lag_task = None
+
+@app.on_event("startup")
+async def on_http_startup():
+    global event_loop_lag_task
+    if event_loop_lag_task is None:
+        event_loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    mark_startup_phase('http ready')
+
+# Registration sessions. Each pending !beli step waits on a future keyed by
+# (channel_id, author_id), so routing a message is one dict lookup no matter
+# how many registrations are open. Timeouts are handled by one reaper task
+# that pops deadlines off a heap instead of one timer per waiter
+class SessionManager:
+    def __init__(self, reap_interval):
+        self.reap_interval = reap_interval
+        self.waiters = {}
+        self.deadlines = []
+        self.reaper = None
+
+    def start(self):
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self._reap())
+
+    def stop(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+
+    def __len__(self):
+        return len(self.waiters)
+
+    async def wait_for_message(self, channel_id, author_id, timeout):
+        loop = asyncio.get_running_loop()
+        key = (channel_id, author_id)
+        previous = self.waiters.get(key)
+        if previous is not None:
+            previous.cancel()  # A newer step for the same user replaces the old one
+        future = loop.create_future()
+        self.waiters[key] = future
+        heapq.heappush(self.deadlines, (loop.time() + timeout, id(future), key, future))
+        try:
+            return await future
+        finally:
+            if self.waiters.get(key) is future:
+                del self.waiters[key]
+
+    def dispatch(self, message):
+        future = self.waiters.pop((message.channel.id, message.author.id), None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    async def _reap(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            now = loop.time()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, _, key, future = heapq.heappop(self.deadlines)
+                if not future.done():
+                    future.set_exception(asyncio.TimeoutError())
+                if self.waiters.get(key) is future:
+                    del self.waiters[key]
+
+sessions = SessionManager(SESSION_REAP_INTERVAL)
+
+@bot.listen('on_message')
+async def route_session_message(message):
+    sessions.dispatch(message)
+
+# Product catalog. Each product is a purchasable role; the select menu
+# options and Midtrans item details are built once per catalog load and
+# reused by every !beli. The file is re-read when its mtime changes, and a
+# catalog that fails to parse leaves the previous one in place
+class Product:
+    __slots__ = ('role', 'description', 'price', 'duration_days', 'item_id', 'sheet',
+                 'min_score', 'test_link', 'fallback_role', 'option', 'item_details')
+
+    def __init__(self, entry):
+        self.role = entry['role']
+        self.description = entry.get('description', '')
+        self.price = int(entry['price'])
+        self.duration_days = float(entry.get('duration_days', 30))
+        self.item_id = entry['item_id']
+        self.sheet = entry['sheet']
+        self.min_score = int(entry['min_score']) if entry.get('min_score') is not None else None
+        self.test_link = entry.get('test_link')
+        self.fallback_role = entry.get('fallback_role')
+        if self.min_score is not None and not self.test_link:
+            raise ValueError(f"Produk '{self.role}' membutuhkan test_link karena memiliki min_score")
+        self.option = discord.SelectOption(label=self.role, value=self.role, description=self.description)
+        self.item_details = [{
+            "id": self.item_id,
+            "price": self.price,
+            "quantity": 1,
+            "name": self.role
+        }]
+
+    def payment_payload(self, order_id, customer_name, email):
+        return {
+            "transaction_details": {
+                "order_id": order_id,
+                "gross_amount": self.price
+            },
+            "item_details": self.item_details,
+            "customer_details": {
+                "first_name": customer_name,
+                "email": email
+            }
+        }
+
+class Catalog:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.products = {}
+        self.options = []
+        self.load()
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'r') as f:
+            entries = json.load(f)['products']
+        products = {}
+        for entry in entries:
+            product = Product(entry)
+            if product.role in products:
+                raise ValueError(f"Produk '{product.role}' terdaftar lebih dari sekali")
+            products[product.role] = product
+        if not products:
+            raise ValueError("Katalog tidak berisi produk")
+        self.products = products
+        self.options = [product.option for product in products.values()]
+        self.mtime = mtime
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime  # A broken edit is reported once, not on every check
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Gagal memuat ulang katalog {self.path}, katalog lama tetap dipakai: {e}")
+            return False
+        logger.info(f"Katalog dimuat ulang: {len(self.products)} produk.")
+        return True
+
+    def get(self, role_name):
+        return self.products.get(role_name)
+
+catalog = Catalog(CATALOG_FILE)
+
+async def catalog_watcher():
+    while True:
+        await asyncio.sleep(CATALOG_RELOAD_INTERVAL)
+        catalog.reload_if_changed()
 
 # Discord bot commands
 @bot.command()
 async def beli(ctx):
-    print(f"Perintah !beli dipanggil oleh: {ctx.author.name} (ID: {ctx.author.id})")  
+    logger.info(f"Perintah !beli dipanggil oleh: {ctx.author.name} (ID: {ctx.author.id})")  
 
     # Clear previous user data if exists
-    if ctx.author.id in user_emails:  
-        del user_emails[ctx.author.id]
-    if ctx.author.id in user_names:  
-        del user_names[ctx.author.id]
-    if ctx.author.id in user_phone_numbers:  
-        del user_phone_numbers[ctx.author.id]
+    registration = touch_registration(ctx.author.id)
+    registration.email = registration.name = registration.phone = None
+    store.clear_user_fields(ctx.author.id, ('email', 'name', 'phone'))
 
     now = datetime.now()
     await ctx.send("🎉 **Pembayaran Role**\nHalo! 👋 Silakan masukkan email kamu untuk memulai proses pembayaran:")
-    print(f"Pesan email dikirim ke {ctx.author.name} (ID: {ctx.author.id})") 
-
-    user_members[ctx.author.id] = ctx.author.name  # Store only the name
+    logger.debug("Pesan email dikirim ke %s (ID: %s)", ctx.author.name, ctx.author.id) 
 
-    def check_email(m):
-        return m.author == ctx.author and m.channel == ctx.channel
+    registration.member_name = ctx.author.name  # Store only the name
+    store.set_user_field(ctx.author.id, 'member_name', ctx.author.name)
 
     try:
-        email_msg = await bot.wait_for('message', check=check_email, timeout=60.0)
+        email_msg = await sessions.wait_for_message(ctx.channel.id, ctx.author.id, timeout=SESSION_TIMEOUT)
         email = email_msg.content
         if "@" not in email or "." not in email:
             await ctx.send("❌ **Oops!** Masukkan email yang valid, ya!")
             return
-        user_emails[ctx.author.id] = email
+        touch_registration(ctx.author.id).email = email
+        store.set_user_field(ctx.author.id, 'email', email)
 
         await ctx.send("📋 **Masukkan Nama Lengkap**\nSilakan masukkan nama lengkap kamu:")
-        print(f"Pesan nama dikirim ke {ctx.author.name} (ID: {ctx.author.id})") 
+        logger.debug("Pesan nama dikirim ke %s (ID: %s)", ctx.author.name, ctx.author.id) 
 
-        def check_name(m):
-            return m.author == ctx.author and m.channel == ctx.channel
-
-        name_msg = await bot.wait_for('message', check=check_name, timeout=60.0)
+        name_msg = await sessions.wait_for_message(ctx.channel.id, ctx.author.id, timeout=SESSION_TIMEOUT)
         name = name_msg.content
-        user_names[ctx.author.id] = name
+        touch_registration(ctx.author.id).name = name
+        store.set_user_field(ctx.author.id, 'name', name)
 
         await ctx.send("📞 **Masukkan Nomor Telepon**\nSilakan masukkan nomor telepon kamu:\n*Data kamu akan Yumi gunakan ketika ada kesalahan dalam pembayaran atau sistem kami.*")
-        print(f"Pesan nomor telepon dikirim ke {ctx.author.name} (ID: {ctx.author.id})")  
-
-        def check_phone(m):
-            return m.author == ctx.author and m.channel == ctx.channel
+        logger.debug("Pesan nomor telepon dikirim ke %s (ID: %s)", ctx.author.name, ctx.author.id)  
 
-        phone_msg = await bot.wait_for('message', check=check_phone, timeout=60.0)
+        phone_msg = await sessions.wait_for_message(ctx.channel.id, ctx.author.id, timeout=SESSION_TIMEOUT)
         phone = phone_msg.content
-        user_phone_numbers[ctx.author.id] = phone
+        touch_registration(ctx.author.id).phone = phone
+        store.set_user_field(ctx.author.id, 'phone', phone)
 
-        options = [
-            discord.SelectOption(label="THE WARRIORS MONTHLY", value="THE WARRIORS MONTHLY", description="Role buat kamu yang udah bisa trading tapi butuh profile trading harian!!"),
-            discord.SelectOption(label="THE FELLOWS MONTHLY", value="THE FELLOWS MONTHLY", description="Role buat kamu yang pengen belajar intensif dari awal sampai bisa trading!!"),
-        ]
-
-        select = discord.ui.Select(placeholder="Pilih role yang ingin kamu beli...", options=options)
+        select = discord.ui.Select(placeholder="Pilih role yang ingin kamu beli...", options=list(catalog.options))
 
         async def select_callback(interaction):
             await interaction.response.defer()  # Menunda respons untuk menghindari timeout
             role_name = select.values[0]
-            print(f"Role yang dipilih: {role_name}")  # Log role yang dipilih
+            logger.debug("Role yang dipilih: %s", role_name)  # Log role yang dipilih
+            product = catalog.get(role_name)
+            if product is None:
+                # Removed from the catalog after the menu was sent
+                await interaction.followup.send(f"❌ **Role '{role_name}' sudah tidak tersedia.** Silakan coba lagi dengan `!beli`.")
+                return
             
-            if role_name == "THE WARRIORS MONTHLY":
+            if product.min_score is not None:
                 # Send test link and ask for score
                 await interaction.followup.send(
-                    f"🔗 **Silakan kerjakan tes berikut untuk mendapatkan akses ke role '{role_name}':**\n{test_link}\n\n**Masukkan nilai kamu (0-100):**"
+                    f"🔗 **Silakan kerjakan tes berikut untuk mendapatkan akses ke role '{role_name}':**\n{product.test_link}\n\n**Masukkan nilai kamu (0-100):**"
                 )
 
-                def check_score(m):
-                    return m.author == ctx.author and m.channel == ctx.channel
-
                 try:
-                    score_msg = await bot.wait_for('message', check=check_score, timeout=60.0)
+                    score_msg = await sessions.wait_for_message(ctx.channel.id, ctx.author.id, timeout=SESSION_TIMEOUT)
                     score = int(score_msg.content)
-                    print(f"Nilai yang dimasukkan: {score}") 
+                    logger.debug("Nilai yang dimasukkan: %s", score) 
 
-                    if score < 80:
-                        await interaction.followup.send(
-                            "❌ **Nilai kamu tidak cukup untuk mendapatkan role 'THE WARRIORS MONTHLY'.**\n\n🔍 **Silakan pilih role 'THE FELLOWS MONTHLY':**"
-                        )
+                    if score < product.min_score:
+                        message = f"❌ **Nilai kamu tidak cukup untuk mendapatkan role '{role_name}'.**"
+                        if product.fallback_role:
+                            message += f"\n\n🔍 **Silakan pilih role '{product.fallback_role}':**"
+                        await interaction.followup.send(message)
                         return 
                     
                     else:
-                        # Proceed to payment for THE WARRIORS MONTHLY
+                        # Proceed to payment for the tested role
                         await interaction.followup.send(
                             f"🎊 **Selamat!** Nilai kamu cukup untuk mendapatkan role '{role_name}'.\n\nSilakan lakukan pembayaran di sini:"
                         )
                         
                         try:
                             # Call the process_payment function to handle the payment
-                            await process_payment(interaction, "THE WARRIORS MONTHLY", email, name, phone, select)
+                            await process_payment(interaction, product, email, name, phone, select)
                         except Exception as e:
-                            print(f"Terjadi kesalahan saat memproses pembayaran untuk {interaction.user.name} (ID: {interaction.user.id}): {e}")
+                            logger.error(f"Terjadi kesalahan saat memproses pembayaran untuk {interaction.user.name} (ID: {interaction.user.id}): {e}")
                             await interaction.followup.send("❌ **Kesalahan**\nTerjadi kesalahan saat memproses pembayaran. Silakan coba lagi nanti.", ephemeral=True)
 
                 except ValueError:
@@ -247,8 +1529,8 @@ async def beli(ctx):
                     await interaction.followup.send("⏰ **Waktu habis! Silakan coba lagi.**")
                     return
                 
-            elif role_name == "THE FELLOWS MONTHLY":
-                await process_payment(interaction, "THE FELLOWS MONTHLY", email, name, phone, select)
+            else:
+                await process_payment(interaction, product, email, name, phone, select)
 
         select.callback = select_callback
         view = discord.ui.View()
@@ -258,46 +1540,24 @@ async def beli(ctx):
     except asyncio.TimeoutError:
         await ctx.send("⏰ **Waktu Habis**\nWaktu habis! Silakan coba lagi dengan `!beli`.")
 
-async def process_payment(interaction, role_name, email, name, phone, select):
+async def process_payment(interaction, product, email, name, phone, select):
     order_id = f'order-{interaction.user.id}-{int(time.time())}'
-    print(f"Email: {email}, Name: {name}, Phone: {phone}")
-
-    price = 150000
-    payload = {
-        "transaction_details": {
-            "order_id": order_id,
-            "gross_amount": price
-        },
-        "item_details": [{
-            "id": "item-123",
-            "price": price,
-            "quantity": 1,
-            "name": role_name
-        }],
-        "customer_details": {
-            "first_name": interaction.user.name,
-            "email": email
-        }
-    }
+    logger.debug("Email: %s, Name: %s, Phone: %s", email, name, phone)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Basic {encoded_key}"
-    }
+    payload = product.payment_payload(order_id, interaction.user.name, email)
 
     try:
-        response = requests.post(MIDTRANS_ENDPOINT, json=payload, headers=headers)
-        print(f"Midtrans response: {response.json()}") 
-        response.raise_for_status()
-        payment_url = response.json().get('redirect_url')
+        response = await midtrans_request('POST', MIDTRANS_ENDPOINT, payload)
+        logger.debug("Midtrans response: %s", response) 
+        payment_url = response.get('redirect_url')
 
         if payment_url:
             # Disable previous payment link if exists
-            for oid in payment_status.keys():
-                if payment_status[oid]['user_id'] == interaction.user.id:
-                    payment_status[oid]['status'] = 'canceled'  # Mark previous order as canceled
+            for oid, order in payment_status.for_user(interaction.user.id).items():
+                if order.status == 'pending':
+                    payment_status.set_status(oid, 'canceled')  # Mark previous order as canceled
 
-            payment_status[order_id] = {'status': 'pending', 'role': role_name, 'user_id': interaction.user.id}
+            payment_status.add(order_id, Order(interaction.user.id, product.role, 'pending'))
 
             # Create the payment button
             button = discord.ui.Button(label="💳 Bayar di sini", url=payment_url, style=discord.ButtonStyle.success)
@@ -317,68 +1577,239 @@ async def process_payment(interaction, role_name, email, name, phone, select):
 
         else:
             await interaction.followup.send("❌ **Kesalahan**\nTerjadi kesalahan saat membuat pembayaran. Tidak ada URL pembayaran yang diterima.", ephemeral=True)
-    except requests.exceptions.RequestException as e:
+    except MidtransError as e:
         await interaction.followup.send("❌ **Kesalahan**\nTerjadi kesalahan saat menghubungi Midtrans API. Coba lagi nanti, ya!", ephemeral=True)
-        print(f"Error: {e}")
-        print(f"Response: {response.text}")
+        logger.error(f"Midtrans error: {e}")
+
+# FastAPI payment notification endpoint. Notifications are only validated and
+# recorded in the durable inbox here, so Midtrans gets its ack right away;
+# a retried notification hits the (order_id, transaction_status) key and is
+# not processed twice. The side effects run in inbox_consumer, which lives in
+# the gateway process: with RUN_MODE=web the inbox table in the shared
+# SQLite file is the hand-off, and the consumer picks events up by polling
+inbox_wakeup = asyncio.Event()
+data_loaded = asyncio.Event()
+
+def verify_signature(data):
+    # signature_key = SHA512(order_id + status_code + gross_amount + server key)
+    signature = data.get('signature_key')
+    status_code = data.get('status_code')
+    gross_amount = data.get('gross_amount')
+    if not isinstance(signature, str) or status_code is None or gross_amount is None:
+        return False
+    message = f"{data['order_id']}{status_code}{gross_amount}".encode() + signature_key_bytes
+    expected = hashlib.sha512(message).hexdigest().encode()
+    return hmac.compare_digest(expected, signature.encode())
 
-# FastAPI payment notification endpoint
 @app.post('/payment-notification')
 async def payment_notification(request: Request):
-    data = await request.json()
+    with WEBHOOK_LATENCY.time():
+        result, status_code = await accept_notification(request)
+    WEBHOOK_NOTIFICATIONS.inc(result)
+    return JSONResponse(status_code=status_code, content={"status": result})
+
+async def accept_notification(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return "invalid", 400
     
-    if 'order_id' in data and 'transaction_status' in data:
+    if isinstance(data, dict) and 'order_id' in data and 'transaction_status' in data:
         order_id = data['order_id']
         transaction_status = data['transaction_status']
+
+        # Reject forged notifications before touching any state
+        if not verify_signature(data):
+            logger.warning(f"Invalid signature for order_id {order_id}, notification rejected.")
+            return "invalid signature", 403
         
-        print(f"Received order_id: {order_id}")
-        print(f"Transaction status: {transaction_status}")
+        logger.debug("Received order_id: %s, transaction status: %s", order_id, transaction_status)
         
-        if order_id in payment_status:
-            if transaction_status in ['settlement', 'capture']:
-                user_id = order_id.split('-')[1]
-                guild = bot.get_guild(GUILD_ID)
-                role_name = payment_status[order_id]['role']
-                
-                # Call function_role to add the role
-                bot.loop.create_task(function_role(guild, int(user_id), role_name))
-                
-                payment_status[order_id]['status'] = 'settled'
-                print(f"Update payment status for order_id {order_id}: settled")
-                
-                user = await bot.fetch_user(payment_status[order_id]['user_id'])
-                await user.send(f"✅ **Pembayaran Berhasil**\nPembayaran untuk order ID `{order_id}` telah berhasil! Role `{role_name}` telah ditambahkan")
-                
-                email = user_emails.get(int(user_id))
-                name = user_names.get(int(user_id))
-                phone = user_phone_numbers.get(int(user_id))
-                sheet_name = 'FELLOWS' if role_name == "THE FELLOWS MONTHLY" else 'WARRIORS'
-                gsheet(user_id, email, name, phone, role_name, order_id, 'settled', sheet_name)
-                
-                return JSONResponse(content={"status": "success"})
-        else:
-            print(f"Order ID {order_id} not found in payment_status.")
+        if not store.add_inbox_event(order_id, transaction_status, json.dumps(data)):
+            logger.info(f"Duplicate notification for order_id {order_id} ({transaction_status}) ignored.")
+            return "duplicate", 200
+        inbox_wakeup.set()
+        return "received", 200
     
-    return JSONResponse(content={"status": "ignored"})
+    return "ignored", 200
+
+async def handle_payment_event(order_id, transaction_status, data):
+    if order_id not in payment_status:
+        # The store is shared between processes, so it is the source of truth
+        order = store.get_order(order_id)
+        if order is None:
+            logger.warning(f"Order ID {order_id} not found in payment_status.")
+            return
+        payment_status.cache(order_id, order)
+
+    if transaction_status in ['settlement', 'capture']:
+        order = payment_status[order_id]
+        if order.status == 'settled':
+            return  # settlement and capture for the same order only count once
+        user_id = order.user_id
+        role_name = order.role
+        product = catalog.get(role_name)
+        if product is None:
+            logger.warning(f"Produk '{role_name}' untuk order {order_id} tidak ada di katalog, memakai durasi dan sheet bawaan.")
+        
+        # Recorded before the order counts as settled, so a replay after a
+        # crash cannot skip it; the grant itself runs at the role queue's pace
+        duration_days = product.duration_days if product else 30
+        store.add_role_grant(order_id, user_id, role_name, duration_days)
+        start_role_grant(order_id, user_id, role_name, duration_days)
+        
+        registration = get_registration(user_id) or Registration()
+        email = registration.email
+        name = registration.name
+        phone = registration.phone
+        sheet_name = product.sheet if product else 'WARRIORS'
+        gsheet(str(user_id), email, name, phone, role_name, order_id, 'settled', sheet_name)
+
+        payment_status.set_status(order_id, 'settled')
+        logger.info(f"Update payment status for order_id {order_id}: settled")
+        
+        try:
+            user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+            await user.send(f"✅ **Pembayaran Berhasil**\nPembayaran untuk order ID `{order_id}` telah berhasil! Role `{role_name}` telah ditambahkan")
+        except discord.HTTPException as e:
+            logger.warning(f"Gagal mengirim DM ke user {user_id}: {e}")
+
+    elif transaction_status in ['expire', 'cancel', 'deny']:
+        # Only unpaid orders can still fail; a settled order stays settled
+        if payment_status[order_id].status == 'pending':
+            status = 'expired' if transaction_status == 'expire' else 'canceled'
+            payment_status.set_status(order_id, status)
+            logger.info(f"Update payment status for order_id {order_id}: {status}")
+
+async def inbox_consumer():
+    await data_loaded.wait()
+    while True:
+        inbox_wakeup.clear()
+        failed = False
+        events = store.unprocessed_inbox_events()
+        for order_id, transaction_status, payload in events:
+            try:
+                with PAYMENT_EVENT_LATENCY.time():
+                    await handle_payment_event(order_id, transaction_status, json.loads(payload))
+            except Exception as e:
+                logger.warning(f"Gagal memproses notifikasi {order_id} ({transaction_status}), akan dicoba lagi: {e}")
+                failed = True
+                continue
+            store.mark_inbox_processed(order_id, transaction_status)
+        if failed:
+            await asyncio.sleep(INBOX_RETRY_INTERVAL)
+            continue
+        if inbox_wakeup.is_set() or len(events) == INBOX_BATCH_SIZE:
+            continue  # More events arrived or the batch was full
+        try:
+            # Events accepted in this process wake us up right away; events
+            # written by separate web workers are found by the next poll
+            await asyncio.wait_for(inbox_wakeup.wait(), timeout=INBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# Payment reconciliation. Webhooks can be lost, so pending orders that stayed
+# pending past RECONCILE_MIN_AGE are looked up with the Midtrans status API.
+# Each order is rechecked after a quarter of its age (bounded by the
+# RECONCILE_*_INTERVAL settings), so fresh orders are polled often and old
+# ones back off. Results go into the webhook inbox and take the same path
+# as a real notification
+reconcile_next_check = {}  # order_id -> earliest time of its next status query
+
+def next_reconcile_delay(age):
+    return min(RECONCILE_MAX_INTERVAL, max(RECONCILE_MIN_INTERVAL, age / 4))
+
+async def reconcile_order(order_id, order, semaphore):
+    async with semaphore:
+        try:
+            data = await midtrans_request('GET', MIDTRANS_STATUS_URL.format(order_id=order_id))
+        except MidtransError as e:
+            if e.status != 404:
+                logger.warning(f"Gagal mengecek status order {order_id} ke Midtrans: {e}")
+                RECONCILE_CHECKS.inc('error')
+                reconcile_next_check[order_id] = time.time() + RECONCILE_MIN_INTERVAL
+                return
+            data = {'status_code': '404'}
+
+    now = time.time()
+    age = now - order.created_at
+    reconcile_next_check[order_id] = now + next_reconcile_delay(age)
+    transaction_status = data.get('transaction_status')
+    if transaction_status in (None, 'pending'):
+        # The Snap page was never used, so Midtrans has no transaction for it
+        if str(data.get('status_code')) == '404' and age > RECONCILE_GIVE_UP_HOURS * 60 * 60:
+            transaction_status = 'expire'
+            data = {'order_id': order_id, 'transaction_status': transaction_status, 'source': 'reconciler'}
+        else:
+            RECONCILE_CHECKS.inc('pending')
+            return
+    RECONCILE_CHECKS.inc(transaction_status)
+    if store.add_inbox_event(order_id, transaction_status, json.dumps(data)):
+        logger.info(f"Rekonsiliasi: order {order_id} berstatus {transaction_status} di Midtrans.")
+        inbox_wakeup.set()
+
+async def reconcile_payments():
+    await data_loaded.wait()
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    while True:
+        now = time.time()
+        due = []
+        pending = payment_status.by_status.get('pending', {})
+        for order_id in list(pending):
+            order = payment_status[order_id]
+            if now - order.created_at >= RECONCILE_MIN_AGE and reconcile_next_check.get(order_id, 0) <= now:
+                due.append((order_id, order))
+        for order_id in [order_id for order_id in reconcile_next_check if order_id not in pending]:
+            del reconcile_next_check[order_id]
+        if due:
+            try:
+                await asyncio.gather(*(reconcile_order(order_id, order, semaphore) for order_id, order in due))
+            except Exception as e:
+                logger.error(f"Terjadi kesalahan saat rekonsiliasi pembayaran: {e}")
+        await asyncio.sleep(RECONCILE_MIN_INTERVAL / 2)
+
+# Metrics endpoint. Gauges are read at scrape time so the hot paths only pay
+# for the histogram observations
+# Backlogs kept in the shared store are reported by every process; the rest
+# is state of the gateway process, which web workers would only report as 0
+gauges.extend([
+    ('webhook_inbox_backlog', 'Payment notifications not yet processed.', lambda: store.inbox_backlog()),
+    ('role_grant_backlog', 'Paid role grants not yet applied.', lambda: store.role_grant_backlog()),
+])
+metrics.append(LabeledGauge('startup_phase_seconds', 'Seconds from module import to each startup phase reached.',
+                            'phase', startup_phases))
+if RUN_MODE != 'web':
+    gauges.extend([
+        ('role_queue_depth', 'Role mutations queued or in flight.', lambda: role_queue.depth()),
+        ('sheet_queue_depth', 'Rows waiting to be appended to Google Sheets.', lambda: len(sheet_rows)),
+        ('open_sessions', 'Registration steps waiting for a reply.', lambda: len(sessions)),
+        ('orders', 'Orders held in memory.', lambda: len(payment_status)),
+        ('pending_orders', 'Orders still waiting for payment.', lambda: len(payment_status.by_status.get('pending', ()))),
+        ('active_roles', 'Purchased roles with a scheduled expiry.', lambda: len(role_expiry)),
+        ('expiry_heap_size', 'Entries in the role expiry heap, including stale ones.', lambda: len(expiry_heap)),
+        ('registered_users', 'Users with registration data in memory.', lambda: len(registrations)),
+    ])
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+# With RUN_MODE=bot the gateway process runs no webhook server, so it serves
+# its own metrics on METRICS_PORT
+metrics_app = FastAPI()
+metrics_app.add_api_route('/metrics', metrics_endpoint, methods=['GET'])
+metrics_app.on_event('startup')(on_http_startup)
 
 @bot.event
 async def on_ready():
     load_data()  # Load data when the bot is ready
-    print(f"Bot telah siap sebagai {bot.user.name} (ID: {bot.user.id})")
+    mark_startup_phase('gateway ready')
+    logger.info(f"Bot telah siap sebagai {bot.user.name} (ID: {bot.user.id})")
     guild = bot.get_guild(GUILD_ID)
     if guild:
-        print(f"Bot berada di guild: {guild.name} (ID: {guild.id})")
+        logger.info(f"Bot berada di guild: {guild.name} (ID: {guild.id})")
     else:
-        print(f"Bot tidak berada di guild dengan ID {GUILD_ID}")
-
-    # Print loaded data for verification
-    print("Data yang dimuat dari JSON:")
-    print("User Emails:", user_emails)
-    print("User Names:", user_names)
-    print("User Phone Numbers:", user_phone_numbers)
-    print("Payment Status:", payment_status)
-    print("Role Expiry:", role_expiry)
-    print("User Members:", user_members)
+        logger.warning(f"Bot tidak berada di guild dengan ID {GUILD_ID}")
 
 @bot.command()
 async def closechannel(ctx):
@@ -401,75 +1832,101 @@ async def closechannel(ctx):
 async def checkpay(ctx):
     """Command to check payment status."""
     user_id = ctx.author.id
-    user_payments = {oid: status for oid, status in payment_status.items() if status['user_id'] == user_id}
+    user_payments = payment_status.for_user(user_id)
 
     if not user_payments:
         await ctx.send("❌ **Tidak ada pembayaran yang ditemukan untuk Anda.**")
         return
 
     response = "📜 **Status Pembayaran Anda:**\n"
-    for order_id, status in user_payments.items():
-        response += f"**Order ID:** {order_id} - **Status:** {status['status']}\n"
+    for order_id, order in user_payments.items():
+        response += f"**Order ID:** {order_id} - **Status:** {order.status}\n"
 
     await ctx.send(response)
 
-# Function to save data to a JSON file
-def save_data():
-    data = {
-        "user_emails": user_emails,
-        "user_names": user_names,
-        "user_phone_numbers": user_phone_numbers,
-        "payment_status": payment_status,
-        "role_expiry": {user_id: (role.name if role else None, expiry_time) for user_id, (role, expiry_time) in role_expiry.items()},  # Store role names instead of Role objects
-        "user_members": {user_id: name for user_id, name in user_members.items()},  # Store only names
-    }
-    with open('data.json', 'w') as f:
-        json.dump(data, f)
-
-# Function to load data from a JSON file
+# Function to load data from the SQLite store
 def load_data():
-    global user_emails, user_names, user_phone_numbers, payment_status, role_expiry, user_members
-    try:
-        with open('data.json', 'r') as f:
-            data = json.load(f)
-            user_emails = data.get("user_emails", {})
-            user_names = data.get("user_names", {})
-            user_phone_numbers = data.get("user_phone_numbers", {})
-            payment_status = data.get("payment_status", {})
-            role_expiry = {user_id: (discord.utils.get(bot.get_guild(GUILD_ID).roles, name=role_name), expiry_time) for user_id, (role_name, expiry_time) in data.get("role_expiry", {}).items()}  # Load roles by name
-            user_members = data.get("user_members", {})  # Load names only
-            
-            # Print loaded data for verification
-            print("Data yang dimuat dari JSON:")
-            print("User Emails:", user_emails)
-            print("User Names:", user_names)
-            print("User Phone Numbers:", user_phone_numbers)
-            print("Payment Status:", payment_status)
-            print("Role Expiry:", role_expiry)
-            print("User Members:", user_members)
+    global registrations, role_expiry
+    if store.is_empty() and os.path.exists(LEGACY_DATA_FILE):
+        try:
+            with open(LEGACY_DATA_FILE, 'r') as f:
+                store.import_snapshot(json.load(f))
+            logger.info(f"Data dari {LEGACY_DATA_FILE} telah dipindahkan ke {DB_FILE}.")
+        except json.JSONDecodeError:
+            logger.warning("Error decoding JSON data. Skipping migration.")
 
-    except FileNotFoundError:
-        print("Data file not found. Starting with empty data.")
-    except json.JSONDecodeError:
-        print("Error decoding JSON data. Starting with empty data.")
+    data = store.load(time.time() - REGISTRATION_TTL_HOURS * 60 * 60)
+    registrations = data["registrations"]
+    payment_status.load(data["payment_status"])
+    # Roles are resolved by ID so that renaming one does not orphan its expiries
+    role_expiry = {user_id: (guild_cache.role_by_id(role_id, role_name), expiry_time)
+                   for user_id, (role_id, role_name, expiry_time) in data["role_expiry"].items()}
+    for user_id, (role_id, role_name, expiry_time) in data["role_expiry"].items():
+        role = role_expiry[user_id][0]
+        if role is None:
+            logger.warning(f"Role '{role_name}' (ID: {role_id}) untuk user {user_id} tidak ditemukan di guild.")
+        elif role_id is None:
+            store.set_role_expiry(user_id, role.name, expiry_time, role.id)  # Backfill the ID
+    rebuild_expiry_heap()
+    data_loaded.set()
+
+    logger.info(f"Data dimuat dari database: {len(registrations)} user, {len(payment_status)} order, "
+                f"{len(role_expiry)} role aktif.")
+
+mark_startup_phase('import')
 
 # FastAPI server startup
-async def start_fastapi():
-    port = int(os.getenv('PORT', 8080)) 
-    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
+async def start_fastapi(server_app=app, port=None):
+    port = port or int(os.getenv('PORT', 8080)) 
+    config = uvicorn.Config(server_app, host="0.0.0.0", port=port, log_level="info")
     server = uvicorn.Server(config)
     await server.serve()
 
 # Main function to run the bot and FastAPI
 async def main():
+    load_sheet_spool()
+    asyncio.create_task(warm_up_sheets_service())
     schedule_role_removal.start()
-    fastapi_task = asyncio.create_task(start_fastapi())
-    await bot.start(TOKEN)
-    await fastapi_task
+    role_queue.start()
+    sessions.start()
+    sheet_writer_task = asyncio.create_task(sheet_writer())
+    role_expiry_task = asyncio.create_task(role_expiry_scheduler())
+    inbox_task = asyncio.create_task(inbox_consumer())
+    grant_task = asyncio.create_task(role_grant_retrier())
+    retention_task = asyncio.create_task(retention_sweeper())
+    reconcile_task = asyncio.create_task(reconcile_payments())
+    catalog_task = asyncio.create_task(catalog_watcher())
+    if RUN_MODE == 'all':
+        fastapi_task = asyncio.create_task(start_fastapi())
+    else:
+        fastapi_task = asyncio.create_task(start_fastapi(metrics_app, METRICS_PORT))
+    try:
+        await bot.start(TOKEN)
+        if fastapi_task is not None:
+            await fastapi_task
+    finally:
+        sheet_writer_task.cancel()
+        role_expiry_task.cancel()
+        inbox_task.cancel()
+        grant_task.cancel()
+        retention_task.cancel()
+        reconcile_task.cancel()
+        catalog_task.cancel()
+        role_queue.stop()
+        sessions.stop()
+        await flush_sheet_rows()  # Flush whatever is still queued before exiting
+        await close_midtrans_session()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if RUN_MODE == 'web':
+            # Webhook workers only; run a separate RUN_MODE=bot process on the same DB_FILE
+            # A single worker serves this module's app instead of importing main a second time
+            uvicorn.run(app if WEB_WORKERS == 1 else "main:app", host="0.0.0.0", port=int(os.getenv('PORT', 8080)),
+                        workers=WEB_WORKERS)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("Shutting down...")
-        save_data() 
\ No newline at end of file
+        logger.info("Shutting down...")
+    finally:
+        store.close() 